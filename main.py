@@ -22,16 +22,29 @@ import logging
 import re
 import sys
 import time
-from datetime import (datetime, timedelta)
+from datetime import datetime
 from pathlib import Path
 
 import numpy as np
 from dateutil.parser import parse
 from pandas import DataFrame
+from requests import RequestException
 
-from sutils import (MatchUpError, FileSanity)
+import slimit
+import spool
+from sutils import (MatchUpError, FileSanity, UrlParser, SATELLITES, GranuleRefs,
+                    row_columns, time_windows)
 from smatch import MatchUp
-from sget import (getfile, search, UrlParser, SATELLITES)
+from sget import (close_gportal, getfile, search, ObpgDayIndex, VERIFIED)
+from sprobe import probe_content
+from sstore import SubsetStore
+from sarchive import WindowArchive
+from sextract import extract_windows
+from sfilter import (LandMask, MAX_SOLAR_ZENITH, REASONS, prefilter)
+from soverpass import predictor
+from splan import (Manifest, build_plan, read_throughput, row_queries, save_throughput)
+from sstage import (Inventory, Results, ready_rows)
+from snav import NavCache
 
 
 def fmt_time(hms: str, debug, logger):
@@ -343,8 +356,6 @@ def smat_main(ifile: Path
               , debug: bool
               , logger):
     """handles inputs from a file"""
-    from math import isnan
-
     start = time.perf_counter()
 
     sat = parse_vars['sat'][0]
@@ -356,9 +367,53 @@ def smat_main(ifile: Path
 
     max_time_diff = parse_vars.pop('max_time_diff')[0]
     twin_hmn = -1 * int(max_time_diff)
-    twin_mmn = -60 * (max_time_diff - int(max_time_diff))
     twin_hmx = 1 * int(max_time_diff)
-    twin_mmx = 60 * (max_time_diff - int(max_time_diff))
+    # adaptive mode: narrow search first, widen only for rows without a match
+    time_window_step = (parse_vars.pop('time_window_step', None) or [None])[0]
+    windows = time_windows(max_time_diff=max_time_diff, step=time_window_step)
+    # two-phase fetch: ranged probe of nav/flags/window before the full download
+    probe = (parse_vars.pop('probe', None) or [False])[0]
+    # subset-and-keep: regional extracts kept after the day's granules are deleted
+    subset_store = (parse_vars.pop('subset_store', None) or [None])[0]
+    subset_margin = (parse_vars.pop('subset_margin', None) or [50])[0]
+    # raw pixel windows of every match-up, re-aggregated later without re-extraction
+    window_archive = (parse_vars.pop('window_archive', None) or [None])[0]
+    # navigation indexes kept on disk, per granule (per grid for GOCI),
+    # beside the subset store by default
+    nav_cache = (parse_vars.pop('nav_cache', None) or [None])[0]
+    if (nav_cache is None) and subset_store:
+        nav_cache = Path(subset_store).joinpath('nav')
+    nav_cache = NavCache(root=Path(nav_cache)) if nav_cache else None
+    # query-free pre-filter: night-time OC/IOP/Rrs rows and, with a raster, land rows
+    max_solar_zenith = (parse_vars.pop('max_solar_zenith', None) or [MAX_SOLAR_ZENITH])[0]
+    land_mask = (parse_vars.pop('land_mask', None) or [None])[0]
+    land_margin = (parse_vars.pop('land_margin', None) or [1])[0]
+    land_mask = LandMask(path=Path(land_mask)) if land_mask else None
+    # rows no overpass can cover, predicted from local <PLATFORM>.tle files
+    tle_dir = (parse_vars.pop('tle_dir', None) or [None])[0]
+    # per-host request rate/concurrency limits, 'host:key=value,...' (slimit.configure_specs)
+    slimit.configure_specs(specs=parse_vars.pop('host_limits', None))
+    overpass = predictor(tle_dir=tle_dir, mission=sat, logger=logger)
+    store = SubsetStore(root=Path(subset_store), margin=subset_margin, nav_cache=nav_cache) \
+        if subset_store else None
+    # dry run: searches only, the row-to-granule plan is saved to a manifest that
+    # a later run (manifest option) downloads and extracts without searching
+    plan = (parse_vars.pop('plan', None) or [None])[0]
+    manifest = (parse_vars.pop('manifest', None) or [None])[0]
+    # staged run (sstage extract): the granules of the fetch stage inventory, the rows
+    # done are saved to the results manifest after every day
+    inventory = (parse_vars.pop('inventory', None) or [None])[0]
+    results = (parse_vars.pop('results', None) or [None])[0]
+    if inventory and not manifest:
+        raise MatchUpError('an inventory is extracted with the manifest of its plan')
+    if manifest:
+        plan_name = Path(manifest).name
+        inventory = Inventory.open(path=Path(inventory), plan=plan_name) if inventory else None
+        results = Results.open(path=Path(results), plan=plan_name) if results else None
+    manifest = Manifest.load(path=Path(manifest)) if manifest else None
+    if (manifest is not None) and manifest.meta.get('windows'):
+        # the search windows (and bounds) of the plan, whatever time_window_step is given
+        windows = manifest.meta['windows']
 
     data_frame = check_ifile(filename=ifile, debug=debug, logger=logger)
     if debug:
@@ -369,15 +424,62 @@ def smat_main(ifile: Path
                               for key, val in parse_vars.items()
                               if val is not None})
 
+    # SST rows of a day are answered from one OBPG browse index
+    day_index = ObpgDayIndex(url_parser=url_parser, debug=debug) \
+        if url_parser.ocbrowser_search() else None
+
     file_sanity = FileSanity(check_list=[]
                              , instrument=''
                              , logger=logger
-                             , host=parse_vars['host'][0])
+                             , host=parse_vars['host'][0]
+                             , verified=VERIFIED
+                             , nav_cache=nav_cache)
+    # the granules of a staged run belong to the fetch stage inventory
+    file_sanity.keep = inventory is not None
 
     if debug:
         logger.info(data_frame)
     dtype = parse_vars['data_type'][0]
     data_frame = check_geo(ds=data_frame, logger=logger, debug=debug)
+    # float lon/lat (NaN kept), datetime64 times and search bounds of all rows
+    columns = row_columns(data_frame=data_frame, mission=sat, windows=windows)
+    reason, counts = prefilter(columns=columns
+                               , data_type=dtype
+                               , max_time_diff=max_time_diff
+                               , max_solar_zenith=max_solar_zenith
+                               , land_mask=land_mask
+                               , land_margin=land_margin
+                               , overpass=overpass)
+    logger.info('PreFilter: rows not searched\n' +
+                '\n'.join(f'{key:>16}: {val}' for key, val in counts.items()))
+
+    meta = {'input': Path(ifile).name, 'rows': int(data_frame.shape[0]), 'sat': sat,
+            'data_type': dtype, 'max_time_diff': max_time_diff, 'windows': windows}
+    if plan:
+        def plan_search(query):
+            if day_index:
+                # the day index filters the granules on the url_parser time window
+                lon, lat, dt, url_parser.tim_min, url_parser.tim_max = query
+                return day_index.search(lon=lon, lat=lat, dt=dt)
+            return search(url=query, sen=sat, debug=debug, sst_flag=sst_flag)
+
+        plan = Path(plan)
+        queries = row_queries(columns=columns
+                              , reason=reason
+                              , url_parser=url_parser
+                              , windows=windows
+                              , sat=sat
+                              , dtype=dtype
+                              , day_index=day_index
+                              , dx=dx
+                              , dy=dy)
+        manifest = build_plan(rows=queries, search=plan_search, meta=meta, logger=logger)
+        throughput = read_throughput(odir=odir)
+        manifest.save(path=plan, throughput=throughput)
+        logger.info(f'RunPlan\n{manifest.report(throughput=throughput)}\nsaved to: "{plan}"')
+        return plan
+    if manifest is not None:
+        manifest.check(**meta)
     data_frame.replace(np.nan, '-999', inplace=True)
 
     prc = f'{0:.2f}'
@@ -388,8 +490,10 @@ def smat_main(ifile: Path
 
     total = data_frame.shape[0]
     dec, iter_counter = len(f'{total}'), 0
-    dates = np.asarray([d.strftime('%F') for d in data_frame.loc[:, 'Datetime']])
-    unique_days = np.unique(dates)
+    # one stable sort by day, the days are groupby slices of the sorted frame
+    order = columns['order']
+    by_day = data_frame.iloc[order].groupby(columns['day'][order], sort=False)
+    lons, lats, times, bounds = columns['lon'], columns['lat'], columns['time'], columns['bounds']
     match_up_file = f'No valid satellite match-ups found for any lat/lon/time pairs in {ifile}'
 
     # ============ PARAMS ==============
@@ -414,33 +518,43 @@ def smat_main(ifile: Path
         , 'logger': logger
     }
 
-    mode, tds, header_saved = 'w', unique_days.size, False
+    # granules are deleted only once no later row of the input file needs them
+    refs = GranuleRefs(times=times, max_time_diff=max_time_diff)
+    kept = {}
+
+    mode, tds, header_saved = 'w', by_day.ngroups, False
+    if results is not None:
+        # restarted extract stage, appended to the rows already written
+        header_saved = len(results.rows) > 0
     tec, found = len(f'{tds}'), 0
     # Process files on daily basis to avoid too much data download
-    for d, day in enumerate(unique_days):
+    for d, (key, match) in enumerate(by_day):
+        day = np.datetime64(key, 'D')
         info = f'Day: {day}, {(d + 1):{tec}} in {tds}'
         logger.info(f'{"*" * len(info)}\n{info}\n{"*" * len(info)}')
 
-        match = data_frame.loc[dates == day, :].copy()
-        unmatch = data_frame.loc[dates == day, :].copy()
-
-        match.reset_index(drop=True, inplace=True)
-        unmatch.reset_index(drop=True, inplace=True)
-
-        match['sat_files'] = [[]] * match.shape[0]
-        unmatch['save_empty'] = [True] * unmatch.shape[0]
+        # input-file row IDs of the day, the window archive key
+        row_ids = order[by_day.indices[key]]
+        match = match.reset_index(drop=True)
+        if (inventory is not None) and (results is not None):
+            # rows done, or with granules still being fetched, are left out
+            ready = ready_rows(row_ids=row_ids, manifest=manifest, inventory=inventory,
+                               results=results)
+            if not ready.any():
+                logger.info(f'Stage: no row ready, {row_ids.size} row(s) done or not fetched yet')
+                continue
+            row_ids, match = row_ids[ready], match[ready].reset_index(drop=True)
+        # per-row results, gathered into columns after the row loop
+        sat_files = [[] for _ in range(row_ids.size)]
+        time_window = np.full(row_ids.size, -999.)
         file: Path = Path('.')
 
-        for row, series in match.iterrows():
-            # logger.debug(f'Row: {row} | {series}')
+        for row, pos in enumerate(row_ids):
             iter_counter += 1
             prc = f'{(iter_counter / total * 100):.2f}'
-            lon, lat, dt = series.Lon, series.Lat, series.Datetime
+            lon, lat, dt = lons[pos], lats[pos], times[pos].item()
 
-            url_parser.tim_min = dt + timedelta(hours=twin_hmn,
-                                                minutes=twin_mmn)
-            url_parser.tim_max = dt + timedelta(hours=twin_hmx,
-                                                minutes=twin_mmx)
+            url_parser.tim_min, url_parser.tim_max = (b[pos].item() for b in bounds[windows[-1]])
 
             count = f'FileSearch: {iter_counter:0{dec}} ({prc}%) OUT-OF {total}'
             st_msg = f'     Start: {url_parser.tim_min}'
@@ -452,12 +566,8 @@ def smat_main(ifile: Path
                       f'       End: {url_parser.tim_max}\n' \
                       f'{count}'
 
-            if skip(mission=sat, day=dt.toordinal()):
-                logger.info(f'{message}\nOutSatTimeRange\n{"=" * n}\n')
-                continue
-
-            if isnan(lat) or isnan(lon):
-                logger.info(f'{message}\nNoValid: LonLat\n{"=" * n}\n')
+            if reason[pos]:
+                logger.info(f'{message}\n{REASONS[reason[pos]]}\n{"=" * n}\n')
                 continue
 
             validate_lon(lon=lon)
@@ -467,9 +577,6 @@ def smat_main(ifile: Path
             logger.info(f'{message}\n{"=" * n}')
             # -----------------------------------
 
-            if (sat != 'sgli') and (dtype == 'sst'):
-                url_parser.tim_min = dt
-
             if (sat == 'sgli') or (dtype == 'sst'):
                 url_parser.slat = lat - dy
                 url_parser.elat = lat + dy
@@ -479,55 +586,106 @@ def smat_main(ifile: Path
                 url_parser.slon = lon
                 url_parser.slat = lat
 
-            url = url_parser.csw_url() if sat == 'sgli' else url_parser.cmr_point()
-            if debug:
-                logger.info(url)
-                if host == 'npec':
-                    print(url)
-
-            try:
-                content = search(url=url, sen=sat, debug=debug, sst_flag=sst_flag)
-            except ConnectionResetError:
-                logger.info(time.ctime())
-                raise
-                # ------------------
-            # Download the files
-            # ------------------
-            if content:
-                files = getfile(content=content
-                                , out_dir=odir
-                                , logger=logger
-                                , case=case)
-            else:
-                logger.warning('WARNING: No matching granules found for the row.\n'
-                               'Continuing to search for granules from the rest of the input file...\n')
-                if host == 'npec':
-                    print('WARNING: No matching granules found for the row.\n'
-                          'Continuing to search for granules from the rest of the input file...',
-                          file=sys.stderr)
-                continue
-
-            with open(cntl_file, 'r') as txt:
-                control_list = list(filter(None, txt.readlines()))
-
-            file_sanity.check_list = list(set(files))
-            file_sanity.instrument = sat
-            file_sanity.control_list = control_list
-            files = file_sanity.check()
-
-            if len(files):
-                with open(cntl_file, 'w') as txt:
-                    previous = ''.join(control_list)
-                    current = ''.join([f'{Path(f).name}:OK\n' for f in files])
-                    txt.writelines(f'{previous}\n{current}\n')
-
+            # OBPG SST browser searches are day-based, widening changes nothing
+            row_windows = windows[-1:] if (sat != 'sgli') and (dtype == 'sst') else windows
+            if manifest is not None:
+                # planned run, the granules of the planned window only
+                row_windows = manifest.windows(row=pos)
+                if not row_windows:
+                    logger.info('RunPlan: search failed for the row\n' if int(pos) in manifest.failed
+                                else 'RunPlan: no granule planned for the row\n')
+            for window in row_windows:
+                url_parser.tim_min, url_parser.tim_max = (b[pos].item() for b in bounds[window])
+                if (sat != 'sgli') and (dtype == 'sst'):
+                    url_parser.tim_min = dt
+
+                url = url_parser.csw_url() if sat == 'sgli' else url_parser.cmr_point()
                 if debug:
-                    logger.debug(f'Row: {row}\nIDX\n{match}\nDF\n{match}')
-
-            if len(files) > 0:
-                match.at[row, 'sat_files'] = files
-                unmatch.at[row, 'save_empty'] = False
-                file = Path(files[0])
+                    logger.info(url)
+                    if host == 'npec':
+                        print(url)
+
+                try:
+                    if manifest is not None:
+                        content = manifest.content(row=pos)
+                    elif day_index:
+                        content = day_index.search(lon=lon, lat=lat, dt=dt)
+                    else:
+                        content = search(url=url, sen=sat, debug=debug, sst_flag=sst_flag)
+                except ConnectionResetError:
+                    logger.info(time.ctime())
+                    raise
+                except RequestException as exc:
+                    # retries exhausted or the host circuit is open
+                    logger.warning(f'WARNING: Search failed, skipping the row.\n{exc}\n')
+                    break
+                    # ------------------
+                # the later result pages are pulled lazily by the steps below,
+                # a lost page skips the row
+                try:
+                    if content and probe and (case == 'cmr') and (inventory is None):
+                        content = probe_content(content=content
+                                                , points=[(lon, lat)]
+                                                , out_dir=odir
+                                                , window=kwargs['pixel_window_size']
+                                                , min_valid_pixels=kwargs['min_valid_pixels']
+                                                , l2_bits=kwargs['l2_bits']
+                                                , logger=logger)
+                    stored = []
+                    if content and store:
+                        content, stored = store.split(content=content, lon=lon, lat=lat)
+                    # ------------------
+                    # Download the files
+                    # ------------------
+                    if (content or stored) and (inventory is not None):
+                        files = stored + inventory.local(content=content)
+                    elif content or stored:
+                        files = stored + (getfile(content=content
+                                                  , out_dir=odir
+                                                  , logger=logger
+                                                  , case=case) if content else [])
+                except RequestException as exc:
+                    logger.warning(f'WARNING: Search failed, skipping the row.\n{exc}\n')
+                    break
+                if not (content or stored) and (window < row_windows[-1]):
+                    logger.info(f'TimeWindow: +/-{window} hrs, no granules, widening...')
+                    continue
+                if not (content or stored):
+                    logger.warning('WARNING: No matching granules found for the row.\n'
+                                   'Continuing to search for granules from the rest of the input file...\n')
+                    if host == 'npec':
+                        print('WARNING: No matching granules found for the row.\n'
+                              'Continuing to search for granules from the rest of the input file...',
+                              file=sys.stderr)
+                    continue
+
+                with open(cntl_file, 'r') as txt:
+                    control_list = list(filter(None, txt.readlines()))
+
+                file_sanity.check_list = list(set(files))
+                file_sanity.instrument = sat
+                file_sanity.control_list = control_list
+                file_sanity.points = [(lon, lat)]
+                file_sanity.window = kwargs['pixel_window_size']
+                file_sanity.variables = kwargs['variables']
+                files = file_sanity.check()
+
+                if len(files):
+                    with open(cntl_file, 'w') as txt:
+                        previous = ''.join(control_list)
+                        current = ''.join([f'{Path(f).name}:OK\n' for f in files])
+                        txt.writelines(f'{previous}\n{current}\n')
+
+                    if debug:
+                        logger.debug(f'Row: {row}\nIDX\n{match}\nDF\n{match}')
+
+                if len(files) > 0:
+                    sat_files[row] = files
+                    time_window[row] = window
+                    file = Path(files[0])
+                    break
+        match['sat_files'] = sat_files
+        match['time_window'] = time_window
         # ---------------
         # Get the matchup
         # ---------------
@@ -541,14 +699,83 @@ def smat_main(ifile: Path
         ).get()
         found += cfm
         header_saved = True
-
-        # ---------------------
-        # Del current day files
-        # ---------------------
-        for i, series in match.iterrows():
-            for f in series.sat_files:
+        if results is not None:
+            results.add(row_ids=row_ids, ofile=ofile)
+            results.save()
+        logger.info(f'HostRates\n{slimit.report()}')
+        logger.info(f'HandlePool: {spool.POOL}')
+
+        # --------------------------------
+        # Archive the pixel windows, if set
+        # --------------------------------
+        if window_archive is not None:
+            rows = {}
+            for i, files in enumerate(sat_files):
+                for f in files:
+                    rows.setdefault(Path(f), []).append(i)
+            with WindowArchive(path=Path(window_archive), window=kwargs['pixel_window_size']) as archive:
+                for f, idx in rows.items():
+                    if not (f.is_file() and (f.name.endswith('.nc') or f.name.endswith('.h5'))):
+                        continue
+                    points = list(zip(lons[row_ids[idx]], lats[row_ids[idx]]))
+                    # windows already read by the fused sanity check
+                    cached = [file_sanity.extracted.get((f.name, point)) for point in points]
+                    try:
+                        if all(cached) and cached:
+                            pixel_windows = {name: np.concatenate([c[0][name] for c in cached])
+                                             for name in cached[0][0]}
+                            flags = None if cached[0][1] is None else \
+                                np.concatenate([c[1] for c in cached])
+                            pixels = np.concatenate([c[2] for c in cached])
+                        else:
+                            pixel_windows, flags, pixels = extract_windows(
+                                file=f
+                                , points=points
+                                , window=kwargs['pixel_window_size']
+                                , variables=kwargs['variables']
+                                , nav_cache=nav_cache)
+                        archive.append(row_ids=row_ids[idx], granule=f.name, sensor=sat,
+                                       windows=pixel_windows, flags=flags, pixels=pixels)
+                    except (OSError, KeyError, IndexError, ValueError) as exc:
+                        logger.warning(f'WindowArchive: {f.name} not archived\n{exc}')
+
+        file_sanity.extracted.clear()
+        for pos, files in zip(row_ids, sat_files):
+            for f in files:
+                kept.setdefault(Path(f), []).append((lons[pos], lats[pos]))
+
+        # -----------------------------------------------
+        # Del the files no later day needs, keep regional
+        # subsets (of all the rows they served), if set
+        # -----------------------------------------------
+        next_day = np.datetime64(day) + np.timedelta64(1, 'D')
+        for f in list(kept):
+            if refs.count(file=f, after=next_day) > 0:
+                continue
+            pts = kept.pop(f)
+            if (store is not None) and (f not in store) and f.is_file():
+                try:
+                    store.write(file=f, points=pts, logger=logger)
+                except (OSError, KeyError, IndexError, ValueError) as exc:
+                    logger.warning(f'SubsetStore: {f.name} not kept\n{exc}')
+            if (store is None) or (f not in store):
+                spool.release(file=f)
+                # staged runs leave the granules to the fetch stage
+                if inventory is None:
+                    f.unlink(missing_ok=True)
+        # granules with no valid pixels in the windows of their rows
+        for f in list(file_sanity.rejected):
+            if (f in kept) or (refs.count(file=f, after=next_day) > 0):
+                continue
+            file_sanity.rejected.discard(f)
+            spool.release(file=f)
+            if inventory is None:
                 f.unlink(missing_ok=True)
+        logger.info(f'GranuleRefs: {len(kept)} granule(s) kept for the next days')
 
+    spool.close()
+    close_gportal()
+    save_throughput(odir=odir)
     logger.info(f'{found} match-ups saved to: "{ofile}"')
     if host == 'npec':
         print(f'{found} match-ups saved to "{ofile}"')
@@ -22,14 +22,16 @@ import subprocess
 import sys
 import textwrap
 import time
-from datetime import timedelta
-from math import isnan
 from pathlib import Path
 
 import coloredlogs
-import numpy as np
+from requests import RequestException
 
+import sfilter
 import sget
+import slimit
+import soverpass
+import splan
 import sutils
 
 __version__ = '1.0.1'
@@ -117,9 +119,22 @@ def file_get(output_dir: Path, text_file: str, params: dict, logger: logging):
 
     max_time_diff = params.pop('max_time_diff')[0]
     twin_hmn = -1 * int(max_time_diff)
-    twin_mmn = -60 * (max_time_diff - int(max_time_diff))
     twin_hmx = 1 * int(max_time_diff)
-    twin_mmx = 60 * (max_time_diff - int(max_time_diff))
+    time_window_step = (params.pop('time_window_step', None) or [None])[0]
+    windows = sutils.time_windows(max_time_diff=max_time_diff, step=time_window_step)
+    max_solar_zenith = (params.pop('max_solar_zenith', None) or [sfilter.MAX_SOLAR_ZENITH])[0]
+    land_mask = (params.pop('land_mask', None) or [None])[0]
+    land_margin = (params.pop('land_margin', None) or [1])[0]
+    land_mask = sfilter.LandMask(path=Path(land_mask)) if land_mask else None
+    tle_dir = (params.pop('tle_dir', None) or [None])[0]
+    slimit.configure_specs(specs=params.pop('host_limits', None))
+    overpass = soverpass.predictor(tle_dir=tle_dir, mission=sat, logger=logger)
+    plan = (params.pop('plan', None) or [None])[0]
+    manifest = (params.pop('manifest', None) or [None])[0]
+    manifest = splan.Manifest.load(path=Path(manifest)) if manifest else None
+    if (manifest is not None) and manifest.meta.get('windows'):
+        # the search windows (and bounds) of the plan, whatever time_window_step is given
+        windows = manifest.meta['windows']
 
     data_frame = sutils.check_ifile(filename=Path(text_file)
                                     , debug=DEBUG
@@ -132,36 +147,72 @@ def file_get(output_dir: Path, text_file: str, params: dict, logger: logging):
                                      for key, val in params.items()
                                      if val is not None})
 
+    day_index = sget.ObpgDayIndex(url_parser=url_parser, debug=DEBUG) \
+        if url_parser.ocbrowser_search() else None
+
     file_sanity = sutils.FileSanity(check_list=[]
                                     , instrument=''
                                     , logger=logger
-                                    , host=USER)
+                                    , host=USER
+                                    , verified=sget.VERIFIED)
 
     if DEBUG:
         logger.info(data_frame)
     dtype = params['data_type'][0]
     data_frame = sutils.check_geo(ds=data_frame, logger=logger, debug=DEBUG)
-    data_frame.replace(np.nan, '-999', inplace=True)
+    # float lon/lat (NaN kept), datetime64 times and search bounds of all rows
+    columns = sutils.row_columns(data_frame=data_frame, mission=sat, windows=windows)
+    lons, lats, times, bounds = columns['lon'], columns['lat'], columns['time'], columns['bounds']
+    # night-time OC/IOP/Rrs rows and land rows are never searched
+    reason, counts = sfilter.prefilter(columns=columns
+                                       , data_type=dtype
+                                       , max_time_diff=max_time_diff
+                                       , max_solar_zenith=max_solar_zenith
+                                       , land_mask=land_mask
+                                       , land_margin=land_margin
+                                       , overpass=overpass)
+    logger.info('PreFilter: rows not searched\n' +
+                '\n'.join(f'{key:>16}: {val}' for key, val in counts.items()))
+
+    meta = {'input': Path(text_file).name, 'rows': int(data_frame.shape[0]), 'sat': sat,
+            'data_type': dtype, 'max_time_diff': max_time_diff, 'windows': windows}
+    if plan:
+        def plan_search(query):
+            if day_index:
+                # the day index filters the granules on the url_parser time window
+                lon, lat, dt, url_parser.tim_min, url_parser.tim_max = query
+                return day_index.search(lon=lon, lat=lat, dt=dt)
+            return sget.search(url=query, debug=DEBUG, sst_flag=sst_flag, sen=sat)
+
+        queries = splan.row_queries(columns=columns
+                                    , reason=reason
+                                    , url_parser=url_parser
+                                    , windows=windows
+                                    , sat=sat
+                                    , dtype=dtype
+                                    , day_index=day_index
+                                    , dx=dx
+                                    , dy=dy)
+        manifest = splan.build_plan(rows=queries, search=plan_search, meta=meta, logger=logger)
+        throughput = splan.read_throughput(odir=output_dir)
+        manifest.save(path=Path(plan), throughput=throughput)
+        logger.info(f'RunPlan\n{manifest.report(throughput=throughput)}\nsaved to: "{plan}"')
+        return
+    if manifest is not None:
+        manifest.check(**meta)
 
     prc = f'{0:.2f}'
 
     total = data_frame.shape[0]
     dec, iter_counter = len(f'{total}'), 0
-    dates = np.asarray([d.strftime('%F') for d in data_frame.loc[:, 'Datetime']])
-    unique_days = np.unique(dates)
-
-    mode, tds, header_saved = 'w', unique_days.size, False
-    tec, found = len(f'{tds}'), 0
-    # Process files on daily basis to avoid too much data download
 
-    for row, series in data_frame.iterrows():
-        # logger.debug(f'Row: {row} | {series}')
+    # rows in day order, one stable sort
+    for pos in columns['order']:
         iter_counter += 1
         prc = f'{(iter_counter / total * 100):.2f}'
-        lon, lat, dt = series.Lon, series.Lat, series.Datetime
+        lon, lat, dt = lons[pos], lats[pos], times[pos].item()
 
-        url_parser.tim_min = dt + timedelta(hours=twin_hmn, minutes=twin_mmn)
-        url_parser.tim_max = dt + timedelta(hours=twin_hmx, minutes=twin_mmx)
+        url_parser.tim_min, url_parser.tim_max = (b[pos].item() for b in bounds[windows[-1]])
 
         count = f'FileSearch: {iter_counter:0{dec}} ({prc}%) OUT-OF {total}'
         st_msg = f'     Start: {url_parser.tim_min}'
@@ -173,12 +224,8 @@ def file_get(output_dir: Path, text_file: str, params: dict, logger: logging):
                   f'       End: {url_parser.tim_max}\n' \
                   f'{count}'
 
-        if sutils.skip(mission=sat, day=dt.toordinal()):
-            logger.info(f'{message}\nOutSatTimeRange\n{"=" * n}\n')
-            continue
-
-        if isnan(lat) or isnan(lon):
-            logger.info(f'{message}\nNoValid: LonLat\n{"=" * n}\n')
+        if reason[pos]:
+            logger.info(f'{message}\n{sfilter.REASONS[reason[pos]]}\n{"=" * n}\n')
             continue
 
         sutils.validate_lon(lon=lon)
@@ -188,9 +235,6 @@ def file_get(output_dir: Path, text_file: str, params: dict, logger: logging):
         logger.info(f'{message}\n{"=" * n}')
         # -----------------------------------
 
-        if (sat != 'sgli') and (dtype == 'sst'):
-            url_parser.tim_min = dt
-
         if (sat == 'sgli') or (dtype == 'sst'):
             url_parser.slat = lat - dy
             url_parser.elat = lat + dy
@@ -200,35 +244,67 @@ def file_get(output_dir: Path, text_file: str, params: dict, logger: logging):
             url_parser.slon = lon
             url_parser.slat = lat
 
-        url = url_parser.csw_url() if sat == 'sgli' else url_parser.cmr_point()
-        if DEBUG:
-            logger.info(url)
-
-        try:
-            content = sget.search(url=url
-                                  , debug=DEBUG
-                                  , sst_flag=sst_flag
-                                  , sen=sat)
-        except ConnectionResetError:
-            logger.info(time.ctime())
-            raise
+        row_windows = windows[-1:] if (sat != 'sgli') and (dtype == 'sst') else windows
+        if manifest is not None:
+            row_windows = manifest.windows(row=pos)
+            if not row_windows:
+                logger.info('RunPlan: search failed for the row\n' if int(pos) in manifest.failed
+                            else 'RunPlan: no granule planned for the row\n')
+        for window in row_windows:
+            url_parser.tim_min, url_parser.tim_max = (b[pos].item() for b in bounds[window])
+            if (sat != 'sgli') and (dtype == 'sst'):
+                url_parser.tim_min = dt
+
+            url = url_parser.csw_url() if sat == 'sgli' else url_parser.cmr_point()
+            if DEBUG:
+                logger.info(url)
+
+            try:
+                if manifest is not None:
+                    content = manifest.content(row=pos)
+                elif day_index:
+                    content = day_index.search(lon=lon, lat=lat, dt=dt)
+                else:
+                    content = sget.search(url=url
+                                          , debug=DEBUG
+                                          , sst_flag=sst_flag
+                                          , sen=sat)
+            except ConnectionResetError:
+                logger.info(time.ctime())
+                raise
+            except RequestException as exc:
+                logger.warning(f'WARNING: Search failed, skipping the row.\n{exc}\n')
+                break
+                # ------------------
+            # Download the files
             # ------------------
-        # Download the files
-        # ------------------
-        if content:
-            files = sget.getfile(content=content
-                                 , out_dir=output_dir
-                                 , logger=logger
-                                 , case=case)
-        else:
-            logger.warning('WARNING: No matching granules found for the row.\n'
-                           'Continuing to search for granules from the rest of the input file...\n')
-            continue
-
-        file_sanity.check_list = list(set(files))
-        file_sanity.instrument = sat
-        file_sanity.check()
-
+            if content:
+                try:
+                    # the later result pages are pulled while downloading, a lost page skips the row
+                    files = sget.getfile(content=content
+                                         , out_dir=output_dir
+                                         , logger=logger
+                                         , case=case)
+                except RequestException as exc:
+                    logger.warning(f'WARNING: Search failed, skipping the row.\n{exc}\n')
+                    break
+            elif window < row_windows[-1]:
+                logger.info(f'TimeWindow: +/-{window} hrs, no granules, widening...')
+                continue
+            else:
+                logger.warning('WARNING: No matching granules found for the row.\n'
+                               'Continuing to search for granules from the rest of the input file...\n')
+                continue
+
+            file_sanity.check_list = list(set(files))
+            file_sanity.instrument = sat
+            if len(file_sanity.check()) > 0:
+                logger.info(f'TimeWindow: +/-{window} hrs')
+                break
+
+    logger.info(f'HostRates\n{slimit.report()}')
+    sget.close_gportal()
+    splan.save_throughput(odir=output_dir)
     # -----------------
     # Return the result
     # -----------------
@@ -327,6 +403,52 @@ def cli_main():
       Valid range: decimal number of hours (0-36)
       '''))
 
+    parser.add_argument('--time_window_step', nargs=1, default=([None]), type=float, help=('''\
+      Adaptive time-window search step (hours)
+      OPTIONAL: rows are searched with +/-step hours first and the window is widened
+      by step up to --max_time_diff only for rows that have no valid granule yet
+      Default behavior searches +/-max_time_diff for every row
+      '''))
+
+    parser.add_argument('--max_solar_zenith', nargs=1, default=([sfilter.MAX_SOLAR_ZENITH]),
+                        type=float, help=('''\
+      OC/IOP/Rrs rows where the solar zenith angle stays above this value (degrees)
+      during the whole +/-max_time_diff window are not searched
+      OPTIONAL: default value 75, 0 searches every row
+      '''))
+
+    parser.add_argument('--land_mask', nargs=1, default=([None]), type=str, help=('''\
+      OPTIONAL: netCDF land/water mask raster with 1D lat/lon coordinates
+      Rows on land, away from the coast, are not searched
+      '''))
+
+    parser.add_argument('--land_margin', nargs=1, default=([1]), type=int, help=('''\
+      OPTIONAL: land mask cells around a row that must all be land for the row
+      to be skipped, default value 1 (3x3 cells)
+      '''))
+
+    parser.add_argument('--tle_dir', nargs=1, default=([None]), type=str, help=('''\
+      OPTIONAL: directory of TLE files, one per platform (AQUA.tle, NPP.tle, JPSS1.tle, GCOM-C.tle)
+      Rows no overpass can cover within +/-max_time_diff are not searched (requires sgp4)
+      '''))
+
+    parser.add_argument('--plan', nargs=1, default=([None]), type=str, help=('''\
+      OPTIONAL: dry run, manifest file (JSON) to write
+      The input is pre-filtered and searched only; the unique granules, their total size,
+      the download time at the observed throughput and the match-up count are reported
+      and the row-to-granule plan is saved for a later --manifest run
+      '''))
+
+    parser.add_argument('--manifest', nargs=1, default=([None]), type=str, help=('''\
+      OPTIONAL: run the plan saved by --plan, the planned granules are downloaded, no search
+      '''))
+
+    parser.add_argument('--host_limits', nargs='+', default=None, type=str, help=('''\
+      OPTIONAL: request limits of a host, host:key=value,... (host 'default' for all hosts)
+      Keys: rate, burst, concurrency, max_concurrency, min_rate, max_rate, latency_target
+      e.g. --host_limits cmr.earthdata.nasa.gov:rate=2,concurrency=2 default:latency_target=20
+      '''))
+
     parser.add_argument('--output_dir', nargs=1, type=str, default=([os.getcwd()]), help='''\
       OPTIONAL: output directory for the matchup file 
       Use this flag to save the output data to a separate directory from current working dir
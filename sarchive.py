@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        pixel window archive
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Chunked archive (HDF5, or Zarr for *.zarr paths) of the raw N x N windows of
+every variable and of l2_flags, indexed by in-situ row ID, granule and sensor.
+Other aggregations, QC rules or outlier filters are recomputed from the archive
+for all the rows at once, without running the match-up pipeline again.
+
+Layout
+  row_id            (n,)       int64
+  granule, sensor   (n,)       S128
+  pixel             (n, 2)     int64   window centre row/col in the granule
+  flags             (n, N, N)  int32
+  windows/<var>     (n, N, N)  float32 (NaN outside swath/fill)
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+from pathlib import Path
+
+import h5py
+import numpy as np
+from pandas import DataFrame
+
+try:
+    # optional, *.zarr archives
+    import zarr
+except ImportError:
+    zarr = None
+
+from sstats import batch_stats
+
+CHUNK_ROWS = 256
+NAME_DTYPE = 'S128'
+
+
+class WindowArchive:
+    def __init__(self, path: Path, window: int, mode: str = 'a'):
+        self.path = Path(path)
+        self.window = int(window)
+        if self.path.suffix == '.zarr':
+            if zarr is None:
+                raise ImportError('zarr is required for *.zarr window archives')
+            self.root = zarr.open_group(str(self.path), mode=mode)
+        else:
+            self.root = h5py.File(self.path, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self.root, h5py.File):
+            self.root.close()
+
+    def __len__(self):
+        return self.root['row_id'].shape[0] if 'row_id' in self.root else 0
+
+    def extend(self, name: str, data: np.array, fill=0):
+        """Append rows to dataset `name`, created (and back-filled with `fill`) if needed"""
+        n = len(self)
+        if name not in self.root:
+            shape, chunks = (0,) + data.shape[1:], (CHUNK_ROWS,) + data.shape[1:]
+            if isinstance(self.root, h5py.File):
+                self.root.create_dataset(name, shape=shape, maxshape=(None,) + data.shape[1:],
+                                         chunks=chunks, dtype=data.dtype, fillvalue=fill,
+                                         compression='gzip')
+            else:
+                self.root.create_dataset(name, shape=shape, chunks=chunks,
+                                         dtype=data.dtype, fill_value=fill)
+            if (name != 'row_id') and n:
+                self.root[name].resize((n,) + data.shape[1:])
+        ds = self.root[name]
+        start = ds.shape[0]
+        ds.resize((start + data.shape[0],) + ds.shape[1:])
+        ds[start:] = data
+
+    def datasets(self) -> list:
+        names = [f'windows/{name}' for name in self.root['windows']] \
+            if 'windows' in self.root else []
+        return names + [name for name in ('flags', 'pixel', 'granule', 'sensor', 'row_id')
+                        if name in self.root]
+
+    def truncate(self, n: int):
+        """Cut every dataset back to `n` rows (rows of a failed append)"""
+        for name in self.datasets():
+            ds = self.root[name]
+            if ds.shape[0] > n:
+                ds.resize((n,) + ds.shape[1:])
+
+    def append(self, row_ids, granule: str, sensor: str, windows: dict, flags: np.array = None,
+               pixels: np.array = None):
+        """Add the windows of the rows `row_ids` matched to `granule`"""
+        row_ids = np.asarray(row_ids, dtype=np.int64)
+        n, size = row_ids.size, self.window
+        existing = [name for name in self.root['windows']] if 'windows' in self.root else []
+
+        items = []
+        for name in set(existing) | set(windows):
+            data = windows.get(name)
+            if data is None:
+                data = np.full((n, size, size), np.nan, dtype=np.float32)
+            items.append((f'windows/{name}', data.astype(np.float32), np.nan))
+        items += [('flags', np.zeros((n, size, size), np.int32) if flags is None
+                   else flags.astype(np.int32), 0),
+                  ('pixel', np.full((n, 2), -1, np.int64) if pixels is None
+                   else np.asarray(pixels, dtype=np.int64), -1),
+                  ('granule', np.full(n, Path(granule).name, dtype=NAME_DTYPE), b''),
+                  ('sensor', np.full(n, sensor, dtype=NAME_DTYPE), b''),
+                  # row_id last, its length is the archive length
+                  ('row_id', row_ids, -1)]
+        for name, data, _ in items:
+            if data.shape[0] != n:
+                raise ValueError(f'{name}: {data.shape[0]} rows, {n} row IDs')
+
+        start = len(self)
+        try:
+            for name, data, fill in items:
+                self.extend(name=name, data=data, fill=fill)
+        except BaseException:
+            # all the datasets stay aligned on row_id
+            self.truncate(n=start)
+            raise
+
+    def index(self) -> DataFrame:
+        return DataFrame({'row_id': self.root['row_id'][:],
+                          'granule': self.root['granule'][:].astype(str),
+                          'sensor': self.root['sensor'][:].astype(str)})
+
+    def read(self, variable: str, rows=slice(None)) -> tuple:
+        return self.root[f'windows/{variable}'][rows], self.root['flags'][rows]
+
+    def stats(self, variable, mask: int = 0, min_valid_pixels: int = 1,
+              rows=slice(None), backend: str = None) -> DataFrame:
+        """
+        Window statistics of `variable` (a name or a list of names) for all archived
+        rows in one vectorized pass; pixels with any of the `mask` bits set in l2_flags
+        are excluded. Columns are <variable>_<statistic> when several are given
+        """
+        variables = [variable] if isinstance(variable, str) else list(variable)
+        windows = {name: self.root[f'windows/{name}'][rows] for name in variables}
+        stats = batch_stats(windows=windows, flags=self.root['flags'][rows], mask=mask,
+                            min_valid_pixels=min_valid_pixels, variables=variables,
+                            backend=backend)
+        result = self.index().iloc[rows].reset_index(drop=True)
+        for name in variables:
+            for key, val in stats[name].items():
+                result[key if isinstance(variable, str) else f'{name}_{key}'] = val
+        return result
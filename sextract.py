@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        pixel window extraction
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Raw N x N pixel windows around in-situ stations, read from OBPG L2 netCDF4
+granules (SGLI L2 HDF5 through ssgli). Windows falling over the swath edge
+are padded with NaN (and 0 flags) so that every window has the same shape.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+from pathlib import Path
+
+import numpy as np
+
+from sflags import register, sensor_key
+from spool import dataset
+import ssgli
+from sprobe import nearest_pixel
+from sstats import gather_windows
+
+FLAGS = 'l2_flags'
+
+
+def geophysical_variables(group, variables=None) -> list:
+    """2D geophysical variables of a granule, restricted to `variables` if given"""
+    names = [name for name, var in group.variables.items()
+             if (name != FLAGS) and (var.ndim == 2)]
+    if not variables or variables in ('*', ['*']):
+        return names
+    if isinstance(variables, str):
+        variables = variables.split(',')
+    return [name for name in names if name in variables]
+
+
+def extract_windows(file: Path, points: list, window: int, variables=None, nav_cache=None):
+    """
+    Windows of every variable around each (lon, lat) point. With a `nav_cache`,
+    granules with a cached grid (GOCI) are located without reading navigation
+
+    Returns
+    -------
+        windows: dict
+            variable -> float32 array (points, N, N), fill values as NaN
+        flags: np.array
+            l2_flags (points, N, N) or None when the granule has no l2_flags
+        pixels: np.array
+            (points, 2) centre row/col of each window
+    """
+    if Path(file).name.endswith('.h5'):
+        return ssgli.extract_windows(file=file, points=points, window=window,
+                                     variables=variables)
+    index = nav_cache.get(file=file) if nav_cache is not None else None
+    with dataset(file=file) as dst:
+        geo = dst.groups['geophysical_data']
+        if index is not None:
+            pixels = index.pixels(points=points)
+        else:
+            nav = dst.groups['navigation_data']
+            lat = nav['latitude'][:].filled(np.nan)
+            lon = nav['longitude'][:].filled(np.nan)
+            pixels = np.array([nearest_pixel(lon=lon, lat=lat, plon=plon, plat=plat)
+                               for plon, plat in points], dtype=np.int64).reshape(-1, 2)
+
+        windows = {}
+        for name in geophysical_variables(group=geo, variables=variables):
+            windows[name] = gather_windows(var=geo[name], pixels=pixels, window=window)
+        flags = None
+        if FLAGS in geo.variables:
+            var = geo[FLAGS]
+            var.set_auto_mask(False)
+            register(sensor=sensor_key(Path(file).name), flags=var)
+            flags = gather_windows(var=var, pixels=pixels, window=window, fill=0,
+                                   dtype=np.int32)
+            # pooled handle, back to the default
+            var.set_auto_mask(True)
+    return windows, flags, pixels
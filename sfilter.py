@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        row pre-filter
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Query-free pruning of the in-situ rows no granule could ever match, done for
+all the rows at once before any search:
+  NoValid: LonLat   missing position
+  OutSatTimeRange   outside the mission lifetime
+  SolarZenith       OC/IOP/Rrs rows where the sun stays below `max_solar_zenith`
+                    during the whole +/-max_time_diff window
+  OnLand            land according to a local land/water mask raster (optional)
+  NoOverpass        no overpass within +/-max_time_diff, local TLEs (optional, soverpass)
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+# OBPG Level-2 HISOLZEN threshold, degrees
+MAX_SOLAR_ZENITH = 75.
+# solar zenith sampling step along the search window, hours
+ZENITH_STEP = .5
+ZENITH_CHUNK = 65536
+# products retrieved in daylight only
+DAYLIGHT_TYPES = ('oc', 'iop', 'rrs')
+# reason codes, 0 keeps the row
+REASONS = ('', 'NoValid: LonLat', 'OutSatTimeRange', 'SolarZenith', 'OnLand', 'NoOverpass')
+LAND_MASK_VARS = ('landmask', 'land_mask', 'watermask', 'water_mask', 'mask')
+J2000 = np.datetime64('2000-01-01T12:00:00', 'us')
+
+
+def solar_zenith(times: np.array, lon: np.array, lat: np.array) -> np.array:
+    """Solar zenith angle (degrees) at datetime64 `times`, low-precision almanac (~0.1 deg)"""
+    d = (np.asarray(times, dtype='datetime64[us]') - J2000) / np.timedelta64(1, 'D')
+    g = np.deg2rad(357.529 + 0.98560028 * d)
+    q = 280.459 + 0.98564736 * d
+    ecl = np.deg2rad(q + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obl = np.deg2rad(23.439 - 0.00000036 * d)
+    ra = np.arctan2(np.cos(obl) * np.sin(ecl), np.cos(ecl))
+    dec = np.arcsin(np.sin(obl) * np.sin(ecl))
+    gmst = np.deg2rad((18.697374558 + 24.06570982441908 * d) * 15)
+    hour = gmst + np.deg2rad(lon) - ra
+    lat = np.deg2rad(lat)
+    cos_z = np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(hour)
+    return np.rad2deg(np.arccos(np.clip(cos_z, -1, 1)))
+
+
+def min_solar_zenith(times: np.array, lon: np.array, lat: np.array, hours: float,
+                     step: float = ZENITH_STEP) -> np.array:
+    """Lowest solar zenith angle of each row over its +/-`hours` window"""
+    # both window ends are always sampled, whatever the step
+    offsets = np.unique(np.append(np.arange(-hours, hours, step), hours)) if hours > 0 \
+        else np.zeros(1)
+    offsets = (offsets * 3600 * 1e6).astype(np.int64).astype('timedelta64[us]')
+    times = np.asarray(times, dtype='datetime64[us]')
+    lon, lat = np.asarray(lon), np.asarray(lat)
+    out = np.empty(times.size, dtype=np.float64)
+    # (rows, samples) in chunks, bounded memory for long windows
+    for i in range(0, times.size, ZENITH_CHUNK):
+        part = slice(i, i + ZENITH_CHUNK)
+        out[part] = solar_zenith(times=times[part, None] + offsets, lon=lon[part, None],
+                                 lat=lat[part, None]).min(axis=1)
+    return out
+
+
+class LandMask:
+    """Regular lat/lon land/water raster (netCDF) with 1D lat/lon coordinates"""
+
+    def __init__(self, path: Path, variable: str = None):
+        with Dataset(path, 'r') as dst:
+            if variable is None:
+                variable = next((name for name in LAND_MASK_VARS if name in dst.variables),
+                                None)
+            if variable is None:
+                variable = next(name for name, var in dst.variables.items() if var.ndim == 2)
+            var = dst[variable]
+            lat_name, lon_name = var.dimensions
+            self.lat = np.asarray(dst[lat_name][:], dtype=np.float64)
+            self.lon = np.asarray(dst[lon_name][:], dtype=np.float64)
+            data = np.ma.filled(var[:], 0)
+        # water masks flag water, land masks flag land
+        self.land = (data == 0) if 'water' in variable.lower() else (data != 0)
+
+    @staticmethod
+    def index(coords: np.array, values: np.array) -> np.array:
+        step = (coords[-1] - coords[0]) / (coords.size - 1)
+        return np.clip(np.round((values - coords[0]) / step).astype(np.int64), 0, coords.size - 1)
+
+    def is_land(self, lon: np.array, lat: np.array, margin: int = 1) -> np.array:
+        """Land, the cell and its `margin` neighbour cells (coast stays water)"""
+        row = self.index(coords=self.lat, values=np.asarray(lat))
+        col = self.index(coords=self.lon, values=np.asarray(lon))
+        land = np.ones(row.shape, dtype=bool)
+        for dr in range(-margin, margin + 1):
+            for dc in range(-margin, margin + 1):
+                land &= self.land[np.clip(row + dr, 0, self.lat.size - 1),
+                                  (col + dc) % self.lon.size]
+        return land
+
+
+def prefilter(columns: dict, data_type: str, max_time_diff: float,
+              max_solar_zenith: float = MAX_SOLAR_ZENITH, land_mask: LandMask = None,
+              land_margin: int = 1, overpass=None) -> tuple:
+    """
+    Reason code of every row (sutils.row_columns), 0 for the rows to search,
+    and the number of rows dropped for each reason
+    """
+    lon, lat = columns['lon'], columns['lat']
+    reason = np.zeros(lon.size, dtype=np.int8)
+    valid = np.isfinite(lon) & np.isfinite(lat)
+    reason[~valid] = 1
+    reason[(reason == 0) & columns['skip']] = 2
+
+    todo = np.flatnonzero(reason == 0)
+    if max_solar_zenith and (str(data_type).lower() in DAYLIGHT_TYPES) and todo.size:
+        zenith = min_solar_zenith(times=columns['time'][todo], lon=lon[todo], lat=lat[todo],
+                                  hours=max_time_diff)
+        reason[todo[zenith > max_solar_zenith]] = 3
+
+    todo = np.flatnonzero(reason == 0)
+    if (land_mask is not None) and todo.size:
+        reason[todo[land_mask.is_land(lon=lon[todo], lat=lat[todo], margin=land_margin)]] = 4
+
+    todo = np.flatnonzero(reason == 0)
+    if (overpass is not None) and todo.size:
+        covered = overpass.covered(times=columns['time'][todo], lon=lon[todo], lat=lat[todo],
+                                   hours=max_time_diff)
+        reason[todo[~covered]] = 5
+
+    counts = {REASONS[code]: int((reason == code).sum()) for code in range(1, len(REASONS))}
+    return reason, counts
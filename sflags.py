@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        l2_flags registry
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Per-sensor flag name -> bitmask registry. The flag_meanings/flag_masks
+attributes are parsed once per sensor (first granule seen), `l2_bits` names are
+resolved to one integer, and flag screening is a single np.bitwise_and over a
+window, a stack of windows or a whole scene. Sensors are keyed on the
+platform/instrument of the granule name (old- and new-style OBPG names); SGLI
+QA_flag carries no flag attributes and has its own fixed layout.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import re
+import threading
+
+import numpy as np
+
+# OBPG Level-2 l2_flags, common to all the OBPG sensors
+OBPG_FLAGS = ('ATMFAIL', 'LAND', 'PRODWARN', 'HIGLINT', 'HILT', 'HISATZEN', 'COASTZ', 'SPARE',
+              'STRAYLIGHT', 'CLDICE', 'COCCOLITH', 'TURBIDW', 'HISOLZEN', 'SPARE', 'LOWLW',
+              'CHLFAIL', 'NAVWARN', 'ABSAER', 'SPARE', 'MAXAERITER', 'MODGLINT', 'CHLWARN',
+              'ATMWARN', 'SPARE', 'SEAICE', 'NAVFAIL', 'FILTER', 'SPARE', 'BOWTIEDEL', 'HIPOL',
+              'PRODFAIL', 'SPARE')
+OBPG = 'OBPG'
+# SGLI Level-2 ocean QA_flag (16 bits), no flag_meanings attribute in the granules
+SGLI_FLAGS = ('DATAMISS', 'LAND', 'ATMFAIL', 'CLDICE', 'CLDAFFCTD', 'STRAYLIGHT', 'HIGLINT',
+              'MODGLINT', 'HISOLZ', 'HITAUA', 'EPSOUT', 'TURBIDW', 'HISATZ', 'SPARE', 'SPARE',
+              'SPARE')
+SGLI = 'SGLI'
+
+REGISTRY = {OBPG: {name: 1 << i for i, name in enumerate(OBPG_FLAGS) if name != 'SPARE'},
+            SGLI: {name: 1 << i for i, name in enumerate(SGLI_FLAGS) if name != 'SPARE'}}
+LOCK = threading.Lock()
+
+# OBPG names: AQUA_MODIS.20200101T000000.L2.OC.nc and the older A2020001000000.L2_LAC_OC.nc
+OBPG_NAME = re.compile(r'^([A-Z0-9]+_[A-Z0-9]+)\.')
+OBPG_LEGACY = re.compile(r'^([A-Z])\d{13}')
+LEGACY_MISSION = {'A': 'AQUA_MODIS', 'T': 'TERRA_MODIS', 'S': 'SEASTAR_SEAWIFS',
+                  'V': 'SNPP_VIIRS', 'O': 'ADEOS_OCTS', 'M': 'ENVISAT_MERIS',
+                  'C': 'NIMBUS7_CZCS', 'G': 'COMS_GOCI'}
+
+
+def sensor_key(basename: str) -> str:
+    """
+    Registry key of a granule, the platform/instrument (e.g. AQUA_MODIS), SGLI for
+    GCOM-C granules; OBPG for names of no known mission
+    """
+    if basename.startswith('GC1SG1_'):
+        return SGLI
+    fmt = OBPG_NAME.match(basename)
+    if fmt:
+        return fmt.group(1)
+    fmt = OBPG_LEGACY.match(basename)
+    if fmt is None:
+        return OBPG
+    if (fmt.group(1) == 'V') and ('JPSS1' in basename):
+        return 'JPSS1_VIIRS'
+    return LEGACY_MISSION.get(fmt.group(1), OBPG)
+
+
+def attribute(flags, name: str):
+    """Attribute of an h5py or netCDF4 variable"""
+    if hasattr(flags, 'attrs'):
+        return flags.attrs[name]
+    return flags.getncattr(name)
+
+
+def read_masks(flags) -> dict:
+    """flag name -> bitmask from the flag_meanings/flag_masks attributes"""
+    meanings = attribute(flags, 'flag_meanings')
+    meanings = (meanings.decode() if isinstance(meanings, bytes) else meanings).split()
+    masks = np.atleast_1d(attribute(flags, 'flag_masks')).astype(np.int64)
+    # int32 attributes carry bit 31 as a negative number
+    return {name: int(mask) & 0xFFFFFFFF for name, mask in zip(meanings, masks)}
+
+
+def register(sensor: str, flags=None) -> dict:
+    """Flag masks of `sensor`, parsed from the `flags` variable the first time only"""
+    with LOCK:
+        if (sensor not in REGISTRY) and (flags is not None):
+            REGISTRY[sensor] = read_masks(flags=flags)
+        return REGISTRY.get(sensor, REGISTRY[OBPG])
+
+
+def bitmask(names, sensor: str = OBPG, flags=None) -> int:
+    """
+    Bitmask of the flag `names` (list, or str split on commas/whitespace)
+    for `sensor`; unknown names are ignored
+    """
+    if not names:
+        return 0
+    if isinstance(names, str):
+        names = re.split(r'[,\s]+', names)
+    masks = register(sensor=sensor, flags=flags)
+    mask = 0
+    for name in filter(None, names):
+        mask |= masks.get(name, 0)
+    return mask
+
+
+def flag_mask(flags: np.array, bits: int) -> np.array:
+    """True where any of `bits` is set, same shape as `flags` (window, windows or scene)"""
+    flags = np.asarray(flags)
+    # unsafe cast keeps bit 31 of signed 32-bit flags
+    return np.bitwise_and(flags, np.asarray(bits, dtype=np.int64).astype(flags.dtype)) != 0
+
+
+def flagged_count(flags: np.array, bits: int) -> np.array:
+    """Number of flagged pixels per (..., N, N) window"""
+    return flag_mask(flags=flags, bits=bits).sum(axis=(-2, -1))
@@ -18,15 +18,53 @@ Comments/questions:
   email: maure at npec dot or dot jp (E. R. Maure)
 2020/10/07
 """
-import os
+import atexit
+import ftplib
 import re
-import subprocess
+from datetime import (datetime, timedelta)
+from functools import lru_cache
+from itertools import chain
 from netrc import netrc
 from pathlib import Path
 from pprint import pprint
+from urllib.parse import (parse_qs, urlparse)
 
 import requests
-from requests.adapters import HTTPAdapter
+import urllib3
+
+import shttp
+from sgportal import TransferPool
+
+try:
+    # optional, incremental JSON parsing of the search responses
+    import ijson
+except ImportError:
+    ijson = None
+
+# truncated or malformed result pages: JSON errors and raw (urllib3) read errors
+PAGE_ERRORS = (ValueError, urllib3.exceptions.HTTPError) + \
+              ((ijson.JSONError,) if ijson is not None else ())
+
+GET_FILE = 'https://oceandata.sci.gsfc.nasa.gov/ob/getfile'
+FILE_ID = re.compile(r'filenamelist&id=(\d+\.\d+)')
+FILE_TIME = re.compile(r'\.(\d{8}T\d{6})\.')
+SGLI_FILE = re.compile('standard/GCOM-C/GCOM-C.SGLI/'
+                       'L2.OCEAN.*/GC1SG1_.*Q_.*.h5')
+# fields of a CMR entry used downstream, the rest is dropped while parsing
+CMR_FIELDS = ('id', 'producer_granule_id', 'title', 'time_start', 'time_end',
+              'granule_size', 'boxes', 'polygons')
+CMR_UMM = 'https://cmr.earthdata.nasa.gov/search/granules.umm_json'
+# local file names whose download matched the published checksum
+VERIFIED = set()
+# longest OBPG L2 granule, a granule starting this much before a window still covers it
+GRANULE_LENGTH = timedelta(minutes=10)
+# GPortal transfer backend, protocol='sftp' (needs paramiko) if configured
+GPORTAL = {'host': 'ftp.gportal.jaxa.jp', 'protocol': 'ftp', 'size': 3, 'port': None}
+GPORTAL_POOL = None
+OBPG_SENSORS = {'amod': 'AQUA_MODIS',
+                'tmod': 'TERRA_MODIS',
+                'vrsn': 'SNPP_VIIRS',
+                }
 
 
 def get_auth(host: str):
@@ -41,29 +79,28 @@ def get_auth(host: str):
 
 
 def obpg_search(query: str):
-    with requests.Session() as request:
-        request.mount('https://', HTTPAdapter(max_retries=3))
-        resp = request.get(query, timeout=30)
+    resp = shttp.get(query)
     return get_filename_list(response=resp, query=query)
 
 
+@lru_cache(maxsize=None)
+def file_regex(sen: str, prm: str):
+    return re.compile(f'file=(.*?{sen}.*L2.{prm}.nc)')
+
+
 def get_filename_list(response: requests, query: str) -> list:
     url = query[:-len(Path(query).name) - 1]
-    get_file = 'https://oceandata.sci.gsfc.nasa.gov/ob/getfile'
+    get_file = GET_FILE
 
-    regex = re.compile(r'filenamelist&id=(\d+\.\d+)')
-    fid = regex.findall(response.text)
+    fid = FILE_ID.findall(response.text)
     prm = query[query.index('&prm'):].split('=')[1]
 
     if len(fid) == 0:
         start = query.index('&sen=')
         end = query.index('&per=')
-        sen = {'amod': 'AQUA_MODIS',
-               'tmod': 'TERRA_MODIS',
-               'vrsn': 'SNPP_VIIRS',
-               }[query[start:end].split('=')[1]]
+        sen = OBPG_SENSORS[query[start:end].split('=')[1]]
 
-        files = re.findall(f'file=(.*?{sen}.*L2.{prm}.nc)', response.text)
+        files = file_regex(sen, prm).findall(response.text)
         if len(files) > 0:
             return [f'{get_file}/{f}' for f in files if '&' not in f]
 
@@ -71,8 +108,8 @@ def get_filename_list(response: requests, query: str) -> list:
         print(f'Download >> {query} >> No Files Found...!!! ')
         return []
 
-    response = requests.get(f'{url}/browse.pl?sub=filenamelist&id='
-                            f'{fid[0]}&prm={prm}')
+    response = shttp.get(f'{url}/browse.pl?sub=filenamelist&id='
+                         f'{fid[0]}&prm={prm}')
     if response.reason == 'Not Found':
         return []
 
@@ -80,64 +117,261 @@ def get_filename_list(response: requests, query: str) -> list:
             for f in response.text.splitlines()]
 
 
-def fmt_content(files: list, sst_flag: str = None):
-    contents = {'feed': {'entry': []}}
-    append = contents['feed']['entry'].append
-
+def iter_entries(files, sst_flag: str = None):
     for href in files:
         producer_granule_id = Path(href).name
         if sst_flag and (sst_flag not in producer_granule_id):
             continue
-        entry = {'producer_granule_id': producer_granule_id,
-                 'links': [{'href': href}]}
-        append(entry)
-    return contents
+        yield {'producer_granule_id': producer_granule_id,
+               'links': [{'href': href}]}
 
 
-def search(url: str, sen: str, debug, sst_flag: str = None):
-    """ function to submit a given URL request to the CMR; return JSON output """
+def csw_entries(products, sst_flag: str = None):
+    """Entries of the SGLI L2 ocean products of a CSW search, with their published size"""
+    for product in products:
+        fmt = SGLI_FILE.search(product['fileName'])
+        if fmt is None:
+            continue
+        try:
+            size = int(product.get('size') or 0) or None
+        except (TypeError, ValueError):
+            size = None
+        for entry in iter_entries(files=[fmt.group(0)], sst_flag=sst_flag):
+            yield dict(entry, size=size)
 
-    if (sen != 'sgli') and ('SST' in url):
-        files = obpg_search(query=url)
-        return fmt_content(files=list(set(files)))
 
-    response = requests.get(url)
+def fmt_content(files: list, sst_flag: str = None):
+    return {'feed': {'entry': list(iter_entries(files=files, sst_flag=sst_flag))}}
 
-    if sen != 'sgli':
+
+def lazy_content(entries):
+    """Feed-like content over an entry generator, [] when there are no entries"""
+    first = next(entries, None)
+    if first is None:
+        return []
+    return {'feed': {'entry': chain([first], entries)}}
+
+
+def read_page(response: requests.Response, url: str, prefix: str, item) -> list:
+    """`item` of each JSON array element of a page; a truncated body raises RequestException"""
+    try:
+        return [item(entry) for entry in page_items(response=response, prefix=prefix)]
+    except PAGE_ERRORS as exc:
+        raise requests.RequestException(f'{url}: truncated result page\n{exc}')
+
+
+def page_items(response: requests.Response, prefix: str):
+    """Items of a JSON array at `prefix`, parsed incrementally when ijson is available"""
+    if ijson is None:
         content = response.json()
-        if debug:
-            pprint(f'{content}\n{url}')
-        return content
+        for key in prefix.split('.')[:-1]:
+            content = content.get(key, {})
+        yield from content or []
+        return
+    response.raw.decode_content = True
+    yield from ijson.items(response.raw, prefix, use_float=True)
+
+
+def trim_entry(entry: dict) -> dict:
+    trimmed = {key: entry[key] for key in CMR_FIELDS if key in entry}
+    trimmed['links'] = [{'href': link['href']} for link in entry.get('links', [])[:1]]
+    return trimmed
+
 
+def granule_checksums(ids: list) -> dict:
+    """Published size and checksum (UMM-G) of CMR granules, one request per search page"""
+    if len(ids) == 0:
+        return {}
+    response = shttp.post(CMR_UMM, data={'concept_id[]': ids, 'page_size': len(ids)})
     if response.status_code != 200:
-        return []
-    content = response.json()
+        return {}
+    info = {}
+    for item in response.json().get('items', []):
+        archive = item['umm'].get('DataGranule', {}).get('ArchiveAndDistributionInformation')
+        if not archive:
+            continue
+        checksum = archive[0].get('Checksum') or {}
+        info[item['meta']['concept-id']] = {
+            'checksum': (checksum['Algorithm'], checksum['Value']) if checksum else None,
+            'size': archive[0].get('SizeInBytes')}
+    return info
+
+
+def check_page(response: requests.Response, url: str, debug: bool):
+    """
+    HTTPError for a non-200 result page: a failed first page is a failed search,
+    not an empty one, and a later one would silently truncate the results
+    """
+    if response.status_code == 200:
+        return
     if debug:
-        pprint(f'{content}\n{url}')
+        pprint(f'{response.status_code}\n{url}')
+    raise requests.HTTPError(f'{response.status_code}: result page lost\n{url}',
+                             response=response)
 
-    if content['properties']['numberOfRecordsReturned'] == 0:
-        return []
-    files = re.findall('standard/GCOM-C/GCOM-C.SGLI/'
-                       'L2.OCEAN.*/GC1SG1_.*Q_.*.h5',
-                       '\n'.join([feature['properties']['product']['fileName']
-                                  for feature in content['features']]))
-    sst_flag = f'SST{sst_flag}' if sst_flag else sst_flag
-    if len(files) == 0:
-        return []
-    return fmt_content(files=files, sst_flag=sst_flag)
 
+def cmr_entries(url: str, debug: bool = False, checksums: bool = False):
+    """
+    CMR granule entries, pages are followed lazily through the CMR-Search-After header.
+    With `checksums` the published size/checksum of each page's granules is attached
+    """
+    page_size = int(parse_qs(urlparse(url).query).get('page_size', ['2000'])[0])
+    headers = {}
+    while True:
+        with shttp.get(url, stream=True, headers=headers) as response:
+            check_page(response=response, url=url, debug=debug)
+            search_after = response.headers.get('CMR-Search-After')
+            # one trimmed page is held at a time, the connection is
+            # released before the consumer starts downloading
+            page = read_page(response=response, url=url, prefix='feed.entry.item',
+                             item=lambda entry: trim_entry(entry=entry))
+        if checksums:
+            try:
+                info = granule_checksums(ids=[entry['id'] for entry in page if 'id' in entry])
+            except (requests.RequestException, ValueError, KeyError):
+                info = {}
+            for entry in page:
+                entry.update(info.get(entry.get('id'), {}))
+        if debug:
+            pprint(f'{page}\n{url}')
+        yield from page
+        if (len(page) < page_size) or (search_after is None):
+            return
+        headers = {'CMR-Search-After': search_after}
+
+
+def csw_files(url: str, debug: bool = False):
+    """GPortal product properties (fileName, size), pages are followed lazily through startPosition"""
+    page_size = int(parse_qs(urlparse(url).query).get('count', ['2000'])[0])
+    start = 1
+    while True:
+        with shttp.get(f'{url}&startPosition={start}', stream=True) as response:
+            check_page(response=response, url=url, debug=debug)
+            page = read_page(response=response, url=url, prefix='features.item',
+                             item=lambda feature: feature['properties']['product'])
+        if debug:
+            pprint(f'{page}\n{url}')
+        yield from page
+        if len(page) < page_size:
+            return
+        start += len(page)
+
+
+def in_box(lon: float, lat: float, box: tuple):
+    """Point in (south, west, north, east) box, boxes with west > east cross the dateline"""
+    south, west, north, east = box
+    if not (south <= lat <= north):
+        return False
+    if west <= east:
+        return west <= lon <= east
+    return (lon >= west) or (lon <= east)
+
+
+def get_boxes(entry: dict) -> list:
+    """Coverage boxes (south, west, north, east) of a CMR granule entry"""
+    boxes = [tuple(map(float, box.split()))
+             for box in entry.get('boxes', [])]
+    for polygon in entry.get('polygons', []):
+        for ring in polygon[:1]:
+            coords = list(map(float, ring.split()))
+            lats, lons = coords[0::2], coords[1::2]
+            west, east = min(lons), max(lons)
+            if east - west > 180:
+                # dateline crossing ring, keep the short way round
+                west = min(x for x in lons if x > 0)
+                east = max(x for x in lons if x < 0)
+            boxes.append((min(lats), west, max(lats), east))
+    return boxes
+
+
+class ObpgDayIndex:
+    """
+    Day-level index of the OBPG SST browser
 
-def wget(url: str, out_dir: Path, case: str, logger):
+    The full SST file list of a sensor/day is fetched once (browse.pl list page
+    and filenamelist) together with the granule coverage from CMR, and every
+    row of that day is then answered locally instead of scraping browse.pl per row
     """
-    cmr_download_file downloads a file
-    given URL and out_dir strings
-    syntax fname_local = cmr_download_file(url, out_dir)
+
+    def __init__(self, url_parser, debug: bool = False):
+        self.url_parser = url_parser
+        self.debug = debug
+        self.day = None
+        self.files = {}
+
+    def coverage(self, day: datetime) -> dict:
+        """
+        Coverage boxes of the day's granules; a failed request (non-200 or truncated
+        page, check_page/read_page) is raised (the rows are skipped and the day is
+        reloaded) rather than every file kept as a candidate
+        """
+        url = self.url_parser.cmr_day_coverage(day=day)
+        try:
+            return {entry['producer_granule_id']: get_boxes(entry=entry)
+                    for entry in cmr_entries(url=url)}
+        except ValueError as exc:
+            raise requests.RequestException(f'CMR coverage of {day.date()}: {exc}')
+
+    def load(self, day: datetime):
+        if self.day == day.date():
+            return self
+
+        files = set(obpg_search(query=self.url_parser.ocbrowser(
+            day=day, bbox=(-180, -90, 180, 90))))
+        coverage = self.coverage(day=day)
+        self.files = {}
+        for href in files:
+            name = Path(href).name
+            fmt = FILE_TIME.search(name)
+            self.files[name] = {
+                'href': href,
+                'time': datetime.strptime(fmt.group(1), '%Y%m%dT%H%M%S') if fmt else None,
+                # files without CMR coverage are kept as candidates
+                'boxes': coverage.get(name)
+            }
+        self.day = day.date()
+        if self.debug:
+            pprint(f'{self.day}: {len(self.files)} files indexed')
+        return self
+
+    def in_window(self, start: datetime) -> bool:
+        """Granule starting at `start` overlaps the url_parser tim_min/tim_max window"""
+        if start is None:
+            return True
+        return (self.url_parser.tim_min - GRANULE_LENGTH) <= start <= self.url_parser.tim_max
+
+    def search(self, lon: float, lat: float, dt: datetime):
+        self.load(day=dt)
+        files = [val['href'] for val in self.files.values()
+                 if self.in_window(start=val['time']) and
+                 ((val['boxes'] is None) or
+                  any(in_box(lon=lon, lat=lat, box=box) for box in val['boxes']))]
+        if len(files) == 0:
+            return []
+        return fmt_content(files=files)
+
+
+def search(url: str, sen: str, debug, sst_flag: str = None):
+    """
+    function to submit a given URL request to the CMR/CSW; returns feed-like content
+    whose entries are generated lazily over all the result pages, [] when nothing is found
     """
 
-    bsn = Path(url).name
-    local_dir = out_dir.absolute()
-    local_filename = local_dir.joinpath(bsn)
-    control_file = local_dir.joinpath('control_list.txt')
+    if (sen != 'sgli') and ('SST' in url):
+        files = obpg_search(query=url)
+        return fmt_content(files=list(set(files)))
+
+    if sen != 'sgli':
+        return lazy_content(entries=cmr_entries(url=url, debug=debug, checksums=True))
+
+    sst_flag = f'SST{sst_flag}' if sst_flag else sst_flag
+    return lazy_content(entries=csw_entries(products=csw_files(url=url, debug=debug),
+                                            sst_flag=sst_flag))
+
+
+def checked(local_filename: Path, logger) -> bool:
+    """File already downloaded and listed as OK in the control list"""
+    control_file = local_filename.parent.joinpath('control_list.txt')
 
     if control_file.is_file():
         with open(control_file, 'r') as txt:
@@ -146,66 +380,76 @@ def wget(url: str, out_dir: Path, case: str, logger):
 
         if in_list:
             logger.info(f'{local_filename}\nSUCCESS...! Downloaded file\n')
-            return local_filename
+            return True
+    return False
+
+
+def gportal() -> TransferPool:
+    """Shared pool of logged-in GPortal sessions"""
+    global GPORTAL_POOL
+    if GPORTAL_POOL is None:
+        user, passwd = get_auth(host=GPORTAL['host'])
+        GPORTAL_POOL = TransferPool(user=user, passwd=passwd, **GPORTAL)
+        # runs ended by an error close the sessions too
+        atexit.register(close_gportal)
+    return GPORTAL_POOL
+
+
+def close_gportal():
+    """Log out of the pooled GPortal sessions, at the end of a run"""
+    global GPORTAL_POOL
+    if GPORTAL_POOL is not None:
+        GPORTAL_POOL.close()
+        GPORTAL_POOL = None
+
+
+def wget(url: str, out_dir: Path, case: str, logger,
+         checksum: tuple = None, size: int = None, retries: int = 2):
+    """
+    cmr_download_file downloads a file
+    given URL and out_dir strings
+    syntax fname_local = cmr_download_file(url, out_dir)
+    checksum/size, when published, are verified while the file streams in;
+    truncated/corrupt transfers are re-fetched right away
+    """
+
+    bsn = Path(url).name
+    local_dir = out_dir.absolute()
+    local_filename = local_dir.joinpath(bsn)
+
+    if checked(local_filename=local_filename, logger=logger):
+        return local_filename
 
     if case == 'cmr':
-        host = 'urs.earthdata.nasa.gov'
-        user, passwd = get_auth(host=host)
-        cookies = Path().home().joinpath('.urs_cookies')
-        cmd = 'wget -nc ' \
-              '--auth-no-challenge=on ' \
-              '--keep-session-cookies ' \
-              f'--load-cookies {cookies} ' \
-              f'--save-cookies {cookies} ' \
-              f'--content-disposition "{url}" ' \
-              f'--directory-prefix={local_dir}'
-        if os.name == 'nt':
-            cmd = f'{cmd} ' \
-                  f'--password={passwd} ' \
-                  f'--user={user}'
-        # logger.info(cmd)
-        status = subprocess.check_call(cmd, shell=True)
-        if status != 0:
-            logger.warning(f'WGET exit status: {status}')
-
-        if status == 0:
-            logger.info('SUCCESS!')
+        # Earthdata login through ~/.netrc (urs.earthdata.nasa.gov),
+        # session cookies are kept by the pooled client
+        # verified only when the bytes are hashed here: a file already on disk
+        # is not downloaded (nor hashed) again
+        hashed = (not local_filename.is_file()) and (shttp.new_hash(checksum=checksum) is not None)
+        for attempt in range(retries + 1):
+            try:
+                shttp.download(url=url, path=local_filename, checksum=checksum, size=size)
+                break
+            except shttp.IntegrityError as exc:
+                logger.warning(f'Download corrupt ({attempt + 1}/{retries + 1}): {url}\n{exc}')
+            except (requests.RequestException, OSError) as exc:
+                logger.warning(f'Download failed: {url}\n{exc}')
+                return local_filename
+        else:
+            return local_filename
+        if hashed:
+            VERIFIED.add(local_filename.name)
+        logger.info('SUCCESS!')
         return local_filename
 
     if case == 'csw':
-        """
-        Data retrieval function
-        @return: a list of downloaded files
-        """
-        # get auth
-        host = 'ftp.gportal.jaxa.jp'
-        user, passwd = get_auth(host=host)
-
-        cmd = 'wget -nc ' \
-              '--preserve-permissions ' \
-              '--remove-listing ' \
-              '--tries=5 ' \
-              f'ftp://{user}:{passwd}@{host}/{url} ' \
-              f'--directory-prefix={local_dir}'
-        status = subprocess.check_call(cmd, shell=True)
-        # status = os.system(cmd)
-
-        # -C, --continue-at <offset>
-        #   Continue/Resume a previous file transfer at the given offset.
-        #   Use "-C -" to tell curl to automatically find out where/how to resume the transfer.
-        #   It then uses the given output/input files to figure that out.
-        #
-        # -L, --location
-        #   This option will make curl redo the request on the new place if the server reports
-        #   that the requested page has moved to a different location (indicated with a Location:
-        #   header and a 3XX response code),
-
-        # cmd = f'curl -L -C - ftp://{user}:{passwd}@{host}/{url} --output {bsn}'
-        # status = subprocess.check_call(cmd, cwd=local_dir, shell=True)
-        if status != 0:
-            logger.warning(f'CMD: {cmd}\nStatus: {status}')
-        if status == 0:
-            logger.info('SUCCESS!')
+        # logged-in FTP/SFTP session from the pool, resumes partial files
+        try:
+            gportal().get(remote=url, local=local_filename)
+        except ftplib.all_errors as exc:
+            logger.warning(f'Download failed: {url}\n{exc}')
+            return local_filename
+        logger.info('SUCCESS!')
         return local_filename
 
 
@@ -214,6 +458,7 @@ def getfile(content, out_dir: Path, case: str, logger):
 
     download_files = []
     append = download_files.append
+    remotes = []
 
     for entry in content['feed']['entry']:
         granid = entry['producer_granule_id']
@@ -223,14 +468,25 @@ def getfile(content, out_dir: Path, case: str, logger):
             print(f'Download\n\tID: {granid}\n\tLink: {this_f} | Skipping...\n')
             continue
 
-        if out_dir:
-            local_filename = wget(url=entry['links'][0]['href'],
+        url = entry['links'][0]['href']
+        if out_dir and (case == 'csw'):
+            # GPortal files are fetched in parallel once the entries are known
+            local_filename = out_dir.absolute().joinpath(Path(url).name)
+            if not checked(local_filename=local_filename, logger=logger):
+                remotes.append(url)
+            append(local_filename)
+        elif out_dir:
+            local_filename = wget(url=url,
                                   out_dir=out_dir,
                                   case=case,
-                                  logger=logger)
+                                  logger=logger,
+                                  checksum=entry.get('checksum'),
+                                  size=entry.get('size'))
             append(local_filename)
         else:
-            append(entry['links'][0]['href'])
+            append(url)
 
+    if len(remotes):
+        gportal().get_all(remotes=remotes, out_dir=out_dir, logger=logger)
     # logger.info(download_files)
     return download_files
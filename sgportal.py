@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        GPortal file transfer
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+SGLI granule transfers from JAXA GPortal over a small pool of logged-in
+FTP (or SFTP, if configured) sessions. Several files are fetched at once and
+interrupted transfers resume from the partial file (REST).
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import ftplib
+import queue
+import threading
+import time
+from concurrent.futures import (ThreadPoolExecutor, as_completed)
+from contextlib import contextmanager
+from pathlib import Path
+
+import shttp
+import slimit
+
+try:
+    # optional, SFTP transfers
+    import paramiko
+except ImportError:
+    paramiko = None
+
+HOST = 'ftp.gportal.jaxa.jp'
+TIMEOUT = 120
+BLOCK_SIZE = 1024 * 1024
+# G-Portal SFTP service port
+SFTP_PORT = 2051
+
+
+class FtpSession:
+    def __init__(self, host: str, user: str, passwd: str, timeout: int = TIMEOUT):
+        self.ftp = ftplib.FTP(host, timeout=timeout)
+        self.ftp.login(user=user, passwd=passwd)
+        self.ftp.voidcmd('TYPE I')
+
+    def alive(self) -> bool:
+        try:
+            self.ftp.voidcmd('NOOP')
+        except ftplib.all_errors + (AttributeError,):
+            return False
+        return True
+
+    def size(self, remote: str) -> int:
+        return self.ftp.size(remote)
+
+    def fetch(self, remote: str, fp, offset: int = 0):
+        self.ftp.retrbinary(f'RETR {remote}', fp.write, blocksize=BLOCK_SIZE,
+                            rest=offset or None)
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except ftplib.all_errors:
+            self.ftp.close()
+
+
+class SftpSession:
+    def __init__(self, host: str, user: str, passwd: str, port: int = SFTP_PORT,
+                 timeout: int = TIMEOUT):
+        if paramiko is None:
+            raise ImportError('paramiko is required for SFTP transfers')
+        self.transport = paramiko.Transport((host, port))
+        self.transport.banner_timeout = timeout
+        self.transport.connect(username=user, password=passwd)
+        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+        self.sftp.get_channel().settimeout(timeout)
+
+    def alive(self) -> bool:
+        return self.transport.is_active()
+
+    def size(self, remote: str) -> int:
+        return self.sftp.stat(f'/{remote}').st_size
+
+    def fetch(self, remote: str, fp, offset: int = 0):
+        with self.sftp.open(f'/{remote}', 'rb') as src:
+            src.seek(offset)
+            src.prefetch()
+            while True:
+                block = src.read(BLOCK_SIZE)
+                if not block:
+                    break
+                fp.write(block)
+
+    def close(self):
+        self.sftp.close()
+        self.transport.close()
+
+
+class TransferPool:
+    """Bounded pool of logged-in sessions, reused across files and rows"""
+
+    def __init__(self, user: str, passwd: str, host: str = HOST, size: int = 3,
+                 protocol: str = 'ftp', port: int = None):
+        self.host = host
+        self.user = user
+        self.passwd = passwd
+        self.size = size
+        self.protocol = protocol
+        self.port = port
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        if self.protocol == 'sftp':
+            return SftpSession(host=self.host, user=self.user, passwd=self.passwd,
+                               port=self.port or SFTP_PORT)
+        return FtpSession(host=self.host, user=self.user, passwd=self.passwd)
+
+    @contextmanager
+    def session(self):
+        with self.slots:
+            try:
+                session = self.idle.get_nowait()
+                if not session.alive():
+                    session.close()
+                    session = self.connect()
+            except queue.Empty:
+                session = self.connect()
+            try:
+                yield session
+            except BaseException:
+                # possibly broken control connection, do not return it to the pool
+                session.close()
+                raise
+            self.idle.put(session)
+
+    def get(self, remote: str, local: Path, retries: int = 3) -> Path:
+        """Fetch `remote` into `local`, resuming a partial file when there is one"""
+        if local.is_file():
+            return local
+        part = local.with_name(f'{local.name}.part')
+        limiter = slimit.limiter(host=self.host)
+
+        for attempt in range(retries + 1):
+            limiter.acquire()
+            status, latency = None, float('inf')
+            try:
+                with self.session() as session:
+                    start = time.monotonic()
+                    size = session.size(remote)
+                    latency = time.monotonic() - start
+                    offset = part.stat().st_size if part.is_file() else 0
+                    if offset > size:
+                        part.unlink()
+                        offset = 0
+                    if offset < size:
+                        with open(part, 'ab') as fp:
+                            session.fetch(remote, fp, offset=offset)
+                        shttp.record(received=part.stat().st_size - offset,
+                                     elapsed=time.monotonic() - start)
+                if part.stat().st_size == size:
+                    part.replace(local)
+                    return local
+            except ftplib.error_perm:
+                # missing file or no permission, retrying will not help
+                raise
+            except ftplib.all_errors + (EOFError,):
+                status = 503
+                if attempt == retries:
+                    raise
+            finally:
+                limiter.release(latency=latency, status=status)
+        raise IOError(f'{remote}: incomplete transfer')
+
+    def get_all(self, remotes: list, out_dir: Path, logger) -> list:
+        """Parallel transfers, returns the local files in the order of `remotes`"""
+        local_dir = out_dir.absolute()
+        files = {}
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = {executor.submit(self.get, remote=remote,
+                                       local=local_dir.joinpath(Path(remote).name)): remote
+                       for remote in dict.fromkeys(remotes)}
+            for future in as_completed(futures):
+                remote = futures[future]
+                local = local_dir.joinpath(Path(remote).name)
+                try:
+                    future.result()
+                    logger.info(f'{local}\nSUCCESS!')
+                except ftplib.all_errors + (EOFError,) as exc:
+                    logger.warning(f'Download failed: {remote}\n{exc}')
+                files[remote] = local
+        return [files[remote] for remote in remotes]
+
+    def close(self):
+        while not self.idle.empty():
+            self.idle.get_nowait().close()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        HTTP client
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Shared HTTP layer used by the search and download paths
+  - one keep-alive session (connection pool) per host
+  - connect/read timeouts on every call
+  - exponential backoff with jitter on 429/5xx and connection resets
+  - per-host circuit breaker so that a dead archive fails fast
+  - per-host adaptive rate and concurrency limits (slimit)
+  - large files are fetched as parallel byte ranges when the server allows it
+  - size and published checksum are verified while the bytes stream in
+  - downloaded bytes and transfer time are counted, the observed throughput
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import hashlib
+import os
+import random
+import threading
+import time
+import weakref
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import slimit
+
+# (connect, read) seconds
+TIMEOUT = (15, 120)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+CHUNK_SIZE = 1024 * 1024
+# files from this size up are split in RANGE_PARTS byte ranges
+RANGE_MIN_SIZE = 64 * 1024 * 1024
+RANGE_PARTS = 4
+WRITE_LOCK = threading.Lock()
+
+
+def write_at(fd: int, data: bytes, offset: int):
+    """Positional write, shared by the range workers"""
+    if hasattr(os, 'pwrite'):
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data, offset = data[n:], offset + n
+        return
+    with WRITE_LOCK:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+def preallocate(fd: int, size: int):
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised while a host is failing and its circuit breaker is open"""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+class IntegrityError(IOError):
+    """Downloaded size or checksum does not match the expected value"""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+class ZlibHash:
+    """hashlib-like running Adler-32/CRC32"""
+
+    def __init__(self, name: str):
+        self.func = getattr(zlib, name)
+        self.value = self.func(b'')
+
+    def update(self, data: bytes):
+        self.value = self.func(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f'{self.value & 0xffffffff:08x}'
+
+
+def new_hash(checksum: tuple):
+    """
+    hashlib object of a published (algorithm, value) checksum, e.g. ('SHA-256', '...');
+    None (not verified) for no checksum or an unsupported algorithm
+    """
+    if checksum is None:
+        return None
+    name = checksum[0].lower().replace('-', '')
+    if name in ('adler32', 'crc32'):
+        return ZlibHash(name=name)
+    if name in hashlib.algorithms_available:
+        return hashlib.new(name)
+    return None
+
+
+def file_digest(path: Path, digest, chunk_size: int = CHUNK_SIZE):
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest
+
+
+class CircuitBreaker:
+    def __init__(self, fail_max: int = 5, reset_time: float = 300.):
+        self.fail_max = fail_max
+        self.reset_time = reset_time
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        # half-open: let a trial call through after the cool-down
+        return (time.monotonic() - self.opened_at) >= self.reset_time
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.fail_max:
+            self.opened_at = time.monotonic()
+
+
+def hold_slot(response: requests.Response, limiter: slimit.HostLimiter):
+    """
+    Keep the host concurrency slot of a streamed response until its body is
+    closed (with-block exit), or the response is garbage collected
+    """
+    done = threading.Event()
+
+    def free():
+        if not done.is_set():
+            done.set()
+            limiter.free()
+
+    close = response.close
+
+    def closing():
+        try:
+            close()
+        finally:
+            free()
+
+    response.close = closing
+    weakref.finalize(response, free)
+
+
+class HttpClient:
+    def __init__(self, timeout: tuple = TIMEOUT
+                 , retries: int = 5
+                 , backoff: float = 1.
+                 , max_backoff: float = 60.
+                 , pool_size: int = 8
+                 , fail_max: int = 5
+                 , reset_time: float = 300.):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.fail_max = fail_max
+        self.reset_time = reset_time
+        self.sessions = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+        # completed downloads, bytes and seconds
+        self.received = 0
+        self.elapsed = 0.
+
+    def session(self, host: str) -> requests.Session:
+        """Keep-alive session of a host, TLS handshakes are paid once per host"""
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.sessions[host] = session
+                self.breakers[host] = CircuitBreaker(fail_max=self.fail_max,
+                                                     reset_time=self.reset_time)
+            return self.sessions[host]
+
+    def delay(self, attempt: int, response: requests.Response = None) -> float:
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), self.max_backoff)
+        # full jitter
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Submit a request with retries; the last response is returned when
+        the retries on 429/5xx are exhausted, connection errors are re-raised
+        """
+        host = urlparse(url).netloc
+        session = self.session(host=host)
+        breaker = self.breakers[host]
+        limiter = slimit.limiter(host=host)
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError(f'{host}: circuit open after '
+                                       f'{breaker.failures} consecutive failures')
+            limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout, ConnectionResetError):
+                limiter.release(latency=float('inf'))
+                breaker.failure()
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.delay(attempt=attempt))
+                continue
+            # streamed bodies keep the slot, the limit bounds concurrent transfers
+            stream = kwargs.get('stream', False)
+            limiter.release(latency=time.monotonic() - start, status=response.status_code,
+                            hold=stream)
+            if stream:
+                hold_slot(response=response, limiter=limiter)
+
+            if response.status_code not in RETRY_STATUS:
+                breaker.success()
+                return response
+            breaker.failure()
+            if attempt == self.retries:
+                return response
+            response.close()
+            time.sleep(self.delay(attempt=attempt, response=response))
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('HEAD', url, **kwargs)
+
+    def get_range(self, url: str, fd: int, start: int, end: int,
+                  chunk_size: int = CHUNK_SIZE):
+        """Fetch bytes start-end (inclusive) of `url` into the open file `fd`"""
+        offset = start
+        with self.get(url, stream=True, headers={'Range': f'bytes={start}-{end}'}) as response:
+            if response.status_code != 206:
+                raise requests.HTTPError(f'{response.status_code}: range request not '
+                                         f'honoured', response=response)
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                write_at(fd=fd, data=chunk, offset=offset)
+                offset += len(chunk)
+        if offset != end + 1:
+            raise IntegrityError(f'{url}: incomplete range {start}-{end}, got {offset - start} bytes')
+
+    def get_ranges(self, url: str, part: Path, size: int, parts: int,
+                   chunk_size: int = CHUNK_SIZE):
+        """Parallel byte-range download into a preallocated file"""
+        step = -(-size // parts)
+        ranges = [(start, min(start + step, size) - 1)
+                  for start in range(0, size, step)]
+        fd = os.open(part, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            preallocate(fd=fd, size=size)
+            with ThreadPoolExecutor(max_workers=parts) as executor:
+                futures = [executor.submit(self.get_range, url=url, fd=fd, start=start,
+                                           end=end, chunk_size=chunk_size)
+                           for start, end in ranges]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+
+    def download(self, url: str, path: Path, chunk_size: int = CHUNK_SIZE,
+                 parts: int = RANGE_PARTS, min_size: int = RANGE_MIN_SIZE,
+                 checksum: tuple = None, size: int = None) -> Path:
+        """
+        Stream `url` to `path`; written to a .part file and renamed when complete.
+        Large files from servers with Accept-Ranges are fetched as `parts`
+        parallel byte ranges, the result is checked against the expected size.
+        With a published `checksum` (algorithm, value) the bytes are hashed as they
+        stream in; IntegrityError is raised (and the partial file removed) on mismatch
+        """
+        if path.is_file():
+            return path
+        start = time.monotonic()
+        part = path.with_name(f'{path.name}.part')
+        part.unlink(missing_ok=True)
+        digest = new_hash(checksum=checksum)
+
+        with self.get(url, stream=True) as response:
+            response.raise_for_status()
+            length = int(response.headers.get('Content-Length', 0))
+            # decoded (gzip) bodies do not match Content-Length
+            size = size or (0 if 'Content-Encoding' in response.headers else length)
+            ranged = (parts > 1) and (size >= min_size) and \
+                     (response.headers.get('Accept-Ranges', '').lower() == 'bytes')
+            # ranges go to the final (post-redirect/login) location
+            final_url = response.url
+            if not ranged:
+                with open(part, 'wb') as fp:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        fp.write(chunk)
+                        if digest:
+                            digest.update(chunk)
+
+        if ranged:
+            self.get_ranges(url=final_url, part=part, size=size, parts=parts,
+                            chunk_size=chunk_size)
+            if digest:
+                # ranges arrive out of order, hash the (page-cached) file once
+                file_digest(path=part, digest=digest, chunk_size=chunk_size)
+
+        if size and (part.stat().st_size != size):
+            received = part.stat().st_size
+            part.unlink()
+            raise IntegrityError(f'{url}: size mismatch, expected {size} got {received} bytes')
+        if digest and (digest.hexdigest().lower() != checksum[1].lower()):
+            part.unlink()
+            raise IntegrityError(f'{url}: {checksum[0]} mismatch')
+        part.replace(path)
+        self.record(received=path.stat().st_size, elapsed=time.monotonic() - start)
+        return path
+
+    def record(self, received: int, elapsed: float):
+        """Count a transfer in the throughput, downloads of other transports (GPortal) too"""
+        with self.lock:
+            self.received += received
+            self.elapsed += elapsed
+
+    def throughput(self) -> tuple:
+        """(bytes, seconds) downloaded so far"""
+        with self.lock:
+            return self.received, self.elapsed
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+            self.breakers.clear()
+
+
+CLIENT = HttpClient()
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return CLIENT.get(url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return CLIENT.request('POST', url, **kwargs)
+
+
+def head(url: str, **kwargs) -> requests.Response:
+    return CLIENT.head(url, **kwargs)
+
+
+def download(url: str, path: Path, **kwargs) -> Path:
+    return CLIENT.download(url, path, **kwargs)
+
+
+def record(received: int, elapsed: float):
+    CLIENT.record(received=received, elapsed=elapsed)
+
+
+def throughput() -> tuple:
+    return CLIENT.throughput()
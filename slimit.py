@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        host rate limiter
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Per-host token bucket with AIMD (additive increase, multiplicative decrease)
+concurrency. CMR, OBPG getfile and GPortal throttle differently; the limits
+of each host adapt to the observed latency and 429/503 replies.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import threading
+import time
+
+# default limits, overridden per host with configure()
+DEFAULT_LIMITS = {'rate': 5.
+                  , 'burst': 10
+                  , 'concurrency': 2
+                  , 'max_concurrency': 8
+                  , 'min_rate': .2
+                  , 'max_rate': 20.
+                  , 'latency_target': 10.}
+
+HOST_LIMITS = {
+    'cmr.earthdata.nasa.gov': {'rate': 10., 'concurrency': 4, 'max_concurrency': 8},
+    'oceancolor.gsfc.nasa.gov': {'rate': 2., 'concurrency': 2, 'max_concurrency': 4},
+    'oceandata.sci.gsfc.nasa.gov': {'rate': 5., 'concurrency': 4, 'max_concurrency': 8,
+                                    'latency_target': 30.},
+    'gportal.jaxa.jp': {'rate': 2., 'concurrency': 2, 'max_concurrency': 4},
+    'ftp.gportal.jaxa.jp': {'rate': 2., 'concurrency': 2, 'max_concurrency': 4,
+                            'latency_target': 30.},
+}
+
+THROTTLE_STATUS = (429, 503)
+
+
+class HostLimiter:
+    def __init__(self, host: str, rate: float, burst: int, concurrency: int,
+                 max_concurrency: int, min_rate: float, max_rate: float,
+                 latency_target: float):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.latency_target = latency_target
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.active = 0
+        self.requests = 0
+        self.throttled = 0
+        self.cond = threading.Condition()
+
+    def take(self) -> float:
+        """Take a token; returns the wait (s) needed when the bucket is empty"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.
+        return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+            wait = self.take()
+            while wait > 0:
+                self.cond.wait(timeout=wait)
+                wait = self.take()
+
+    def release(self, latency: float, status: int = None, hold: bool = False):
+        """
+        Adapt the limits to a reply; with `hold` the concurrency slot stays
+        taken (streamed body still transferring) until free()
+        """
+        with self.cond:
+            if not hold:
+                self.active -= 1
+            self.requests += 1
+            if (status in THROTTLE_STATUS) or (latency > self.latency_target):
+                # multiplicative decrease
+                self.throttled += status in THROTTLE_STATUS
+                self.limit = max(1., self.limit / 2)
+                self.rate = max(self.min_rate, self.rate / 2)
+            else:
+                # additive increase, one slot per window of successful calls
+                self.limit = min(self.max_concurrency, self.limit + 1 / max(1., self.limit))
+                self.rate = min(self.max_rate, self.rate + .1)
+            self.cond.notify_all()
+
+    def free(self):
+        """Concurrency slot of a release(hold=True) reply"""
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def __str__(self):
+        return f'{self.host}: rate={self.rate:.2f}/s ' \
+               f'concurrency={int(self.limit)} ' \
+               f'requests={self.requests} ' \
+               f'throttled={self.throttled}'
+
+
+LIMITERS = {}
+LOCK = threading.Lock()
+
+
+def configure(host: str, **kwargs):
+    """Set the limits of a host, e.g. configure('cmr.earthdata.nasa.gov', rate=2.)"""
+    with LOCK:
+        HOST_LIMITS.setdefault(host, {}).update(kwargs)
+        LIMITERS.pop(host, None)
+
+
+def configure_specs(specs: list):
+    """
+    Limits from 'host:key=value,...' specs (run options); host 'default' sets the
+    limits of every host without its own, e.g. 'cmr.earthdata.nasa.gov:rate=2,concurrency=2'
+    """
+    for spec in specs or []:
+        host, _, limits = spec.rpartition(':')
+        if not (host and limits):
+            raise ValueError(f'{spec}: host limits are host:key=value,...')
+        kwargs = {}
+        for item in limits.split(','):
+            key, _, val = item.partition('=')
+            key = key.strip()
+            if key not in DEFAULT_LIMITS:
+                raise ValueError(f'{spec}: unknown limit {key}, one of {", ".join(DEFAULT_LIMITS)}')
+            kwargs[key] = type(DEFAULT_LIMITS[key])(val)
+        if host == 'default':
+            with LOCK:
+                DEFAULT_LIMITS.update(kwargs)
+                LIMITERS.clear()
+            continue
+        configure(host, **kwargs)
+
+
+def limiter(host: str) -> HostLimiter:
+    with LOCK:
+        if host not in LIMITERS:
+            limits = {**DEFAULT_LIMITS, **HOST_LIMITS.get(host, {})}
+            LIMITERS[host] = HostLimiter(host=host, **limits)
+        return LIMITERS[host]
+
+
+def report() -> str:
+    """Current per-host rates, for the run log"""
+    with LOCK:
+        return '\n'.join(f'{LIMITERS[host]}' for host in sorted(LIMITERS))
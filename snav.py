@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        navigation index cache
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Point-to-pixel lookup without a full-scene search. The valid pixels of a
+navigation grid are sorted into coarse lat/lon buckets; a lookup only
+measures the pixels of the buckets around the point. Indexes are saved as
+.npy files and memory-mapped when loaded.
+
+Geostationary sensors (GOCI) have a fixed grid: one index, built from the
+first (reference) granule, serves every later granule of the sensor with the
+same grid. The key holds the grid shape and, for a regional subset (sstore),
+the subset region, so a subset never shares the index of the full grid. Swath granules are
+indexed per granule ID (name and size), for reruns and other in-situ files.
+Every index is saved under the cache
+root (<subset_store>/nav by default); the least recently used swath indexes are
+removed once the cache is over MAX_CACHE_BYTES or older than MAX_CACHE_DAYS.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import json
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from spool import dataset
+from sprobe import nearest_pixel
+
+# bucket size, degrees
+CELL = .1
+# widest bucket search, in buckets around the point, before a full-scene search
+MAX_RING = 32
+# sensors with a fixed navigation grid, granule name tokens -> cache key
+STATIC = {'GOCI': 'GOCI', 'COMS': 'GOCI'}
+ARRAYS = ('lat', 'lon', 'order', 'keys', 'starts')
+# swath indexes kept open (memory-mapped) at once
+MAX_OPEN = 16
+# on-disk cache limits, least recently used swath indexes removed first
+MAX_CACHE_BYTES = 4 * 1024 ** 3
+MAX_CACHE_DAYS = 30
+
+
+def read_navigation(file: Path) -> tuple:
+    """latitude, longitude of an OBPG L2 netCDF4 granule, fill values as NaN"""
+    with dataset(file=file) as dst:
+        nav = dst.groups['navigation_data']
+        return nav['latitude'][:].filled(np.nan), nav['longitude'][:].filled(np.nan)
+
+
+class NavIndex:
+    def __init__(self, lat: np.array, lon: np.array, order: np.array, keys: np.array,
+                 starts: np.array, cell: float = CELL):
+        self.lat, self.lon = lat, lon
+        self.order, self.keys, self.starts = order, keys, starts
+        self.cell = cell
+        self.ncol = int(round(360 / cell))
+
+    @property
+    def shape(self) -> tuple:
+        return self.lat.shape
+
+    def bucket(self, lat, lon):
+        row = np.floor((np.asarray(lat) + 90) / self.cell).astype(np.int64)
+        col = np.floor((np.asarray(lon) + 180) / self.cell).astype(np.int64) % self.ncol
+        return row * self.ncol + col
+
+    @classmethod
+    def build(cls, lat: np.array, lon: np.array, cell: float = CELL):
+        lat = np.asarray(lat, dtype=np.float32)
+        lon = np.asarray(lon, dtype=np.float32)
+        index = cls(lat=lat, lon=lon, order=None, keys=None, starts=None, cell=cell)
+        flat = np.flatnonzero(np.isfinite(lat.ravel()) & np.isfinite(lon.ravel()))
+        buckets = index.bucket(lat=lat.ravel()[flat], lon=lon.ravel()[flat])
+        sort = np.argsort(buckets, kind='stable')
+        index.order = flat[sort].astype(np.int32 if flat.size < 2 ** 31 else np.int64)
+        index.keys, index.starts = np.unique(buckets[sort], return_index=True)
+        index.starts = np.append(index.starts, sort.size).astype(np.int64)
+        return index
+
+    def save(self, path: Path):
+        path = Path(path)
+        part = path.with_name(f'{path.name}.part')
+        shutil.rmtree(part, ignore_errors=True)
+        part.mkdir(parents=True)
+        for name in ARRAYS:
+            np.save(part.joinpath(f'{name}.npy'), getattr(self, name))
+        with open(part.joinpath('index.json'), 'w') as txt:
+            json.dump({'cell': self.cell, 'shape': list(self.shape)}, txt)
+        shutil.rmtree(path, ignore_errors=True)
+        part.replace(path)
+
+    @classmethod
+    def load(cls, path: Path):
+        path = Path(path)
+        with open(path.joinpath('index.json'), 'r') as txt:
+            meta = json.load(txt)
+        arrays = {name: np.load(path.joinpath(f'{name}.npy'), mmap_mode='r')
+                  for name in ARRAYS}
+        return cls(cell=meta['cell'], **arrays)
+
+    def candidates(self, plon: float, plat: float, ring: int) -> np.array:
+        """Flat pixel indices of the (2 * ring + 1)^2 buckets around the point"""
+        row, col = divmod(int(self.bucket(lat=plat, lon=plon)), self.ncol)
+        steps = np.arange(-ring, ring + 1)
+        keys = ((row + steps[:, None]) * self.ncol + (col + steps[None, :]) % self.ncol).ravel()
+        pos = np.searchsorted(self.keys, keys)
+        found = pos < self.keys.size
+        found[found] = self.keys[pos[found]] == keys[found]
+        pos = pos[found]
+        if pos.size == 0:
+            return pos
+        return np.concatenate([self.order[self.starts[p]:self.starts[p + 1]] for p in pos])
+
+    def pixel(self, plon: float, plat: float) -> tuple:
+        """Nearest row/col of (plon, plat), same metric as sprobe.nearest_pixel"""
+        scale = np.cos(np.deg2rad(plat))
+        ring = 1
+        while ring <= MAX_RING:
+            flat = self.candidates(plon=plon, plat=plat, ring=ring)
+            if flat.size:
+                dx = (self.lon.ravel()[flat] - plon) * scale
+                dy = self.lat.ravel()[flat] - plat
+                dist = dx * dx + dy * dy
+                best = int(np.argmin(dist))
+                # exact when the nearest pixel lies inside the searched buckets
+                if np.sqrt(dist[best]) <= ring * self.cell * scale:
+                    return np.unravel_index(flat[best], self.shape)
+            ring *= 2
+        return nearest_pixel(lon=np.asarray(self.lon), lat=np.asarray(self.lat),
+                             plon=plon, plat=plat)
+
+    def pixels(self, points: list) -> np.array:
+        """(points, 2) row/col of each (lon, lat) point"""
+        return np.array([self.pixel(plon=plon, plat=plat) for plon, plat in points],
+                        dtype=np.int64).reshape(-1, 2)
+
+
+class NavCache:
+    def __init__(self, root: Path, cell: float = CELL, max_open: int = MAX_OPEN,
+                 max_bytes: int = MAX_CACHE_BYTES, max_days: float = MAX_CACHE_DAYS):
+        self.root = Path(root)
+        self.cell = cell
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.max_days = max_days
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def static(file: Path) -> str:
+        """Sensor key of a fixed-grid sensor granule, None for swath granules"""
+        name = Path(file).name.upper()
+        for token, key in STATIC.items():
+            if token in name:
+                return key
+        return None
+
+    @staticmethod
+    def grid(file: Path) -> str:
+        """<rows>x<cols> of the navigation grid, with the subset region of an sstore subset"""
+        with dataset(file=file) as dst:
+            grid = 'x'.join(map(str, dst.groups['navigation_data']['latitude'].shape))
+            attrs = dst.ncattrs()
+            if ('subset_rows' in attrs) and ('subset_cols' in attrs):
+                grid += f'.r{dst.getncattr("subset_rows").replace(":", "-")}' \
+                        f'.c{dst.getncattr("subset_cols").replace(":", "-")}'
+        return grid
+
+    def key(self, file: Path) -> str:
+        """
+        Cache key of a granule, the sensor and grid for fixed-grid sensors, the
+        granule ID otherwise; None for granules that cannot be indexed
+        """
+        file = Path(file)
+        if not file.name.endswith('.nc') or not file.is_file():
+            return None
+        key = self.static(file=file)
+        if key is not None:
+            return f'{key}.{self.grid(file=file)}'
+        return f'{file.name}.{file.stat().st_size}'
+
+    def prune(self):
+        """
+        Remove the swath indexes not used for `max_days` and then, least recently
+        used first, those over `max_bytes`; open and fixed-grid indexes are kept
+        """
+        entries = []
+        for path in self.root.iterdir():
+            stamp = path.joinpath('index.json')
+            if (not stamp.is_file()) or (self.static(file=path) is not None):
+                continue
+            size = sum(item.stat().st_size for item in path.iterdir())
+            entries.append((stamp.stat().st_mtime, size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        oldest = time.time() - self.max_days * 86400
+        for used, size, path in entries:
+            if (used >= oldest) and (total <= self.max_bytes):
+                break
+            if path.name in self.indexes:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def get(self, file: Path) -> NavIndex:
+        """
+        Navigation index of `file`, loaded or built (and saved) on first use;
+        None for granules without a cached grid
+        """
+        key = self.key(file=file)
+        if key is None:
+            return None
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                path = self.root.joinpath(key)
+                if path.joinpath('index.json').is_file():
+                    index = NavIndex.load(path=path)
+                    # last use, for the cache eviction
+                    path.joinpath('index.json').touch()
+                else:
+                    lat, lon = read_navigation(file=file)
+                    index = NavIndex.build(lat=lat, lon=lon, cell=self.cell)
+                    index.save(path=path)
+                    self.indexes[key] = index
+                    self.prune()
+                self.indexes[key] = index
+            self.indexes.move_to_end(key)
+            if len(self.indexes) > self.max_open:
+                self.indexes.popitem(last=False)
+        return index
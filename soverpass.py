@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        overpass predictor
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Offline overpass prediction from local TLE files, one file per platform of
+`SATELLITES` (AQUA.tle, NPP.tle, JPSS1.tle, GCOM-C.tle, ...), any number of
+element sets per file. Orbits are propagated with SGP4 once on a regular time
+grid covering the days of the input; a row is covered when the ground track
+passes within half the instrument swath (plus a margin) of the station inside
+its +/-max_time_diff window. Rows with no possible coverage are not searched.
+
+The test is conservative: rows far from every TLE epoch, or whose positions
+failed to propagate, are kept.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+from pathlib import Path
+
+import numpy as np
+
+from sutils import SATELLITES
+
+try:
+    # optional, offline overpass prediction
+    from sgp4.api import Satrec
+except ImportError:
+    Satrec = None
+
+# ground swath width, km
+SWATH_WIDTH = {'CZCS': 1556., 'MERIS': 1150., 'MODIS': 2330., 'OCTS': 1400.,
+               'SeaWiFS': 2801., 'SGLI': 1150., 'VIIRS': 3060.}
+# added to the half swath (km), TLE and spherical-earth errors
+SWATH_MARGIN = 100.
+# ground track sampling step, seconds
+TRACK_STEP = 60
+# LEO ground-track speed, km/s
+TRACK_SPEED = 7.5
+# rows further than this from every TLE epoch are kept, days
+MAX_TLE_AGE = 7.
+ROW_CHUNK = 1024
+EARTH_RADIUS = 6371.
+UNIX_JD = 2440587.5
+J2000 = np.datetime64('2000-01-01T12:00:00', 'us')
+
+
+def read_tle(path: Path) -> list:
+    """Element sets (sgp4 Satrec) of a TLE file, 2- or 3-line format, by epoch"""
+    lines = [line.rstrip() for line in open(path, 'r') if line.strip()]
+    sats = [Satrec.twoline2rv(line1, line2)
+            for line1, line2 in zip(lines[:-1], lines[1:])
+            if line1.startswith('1 ') and line2.startswith('2 ')]
+    return sorted(sats, key=lambda sat: sat.jdsatepoch + sat.jdsatepochF)
+
+
+def julian(times: np.array) -> tuple:
+    """datetime64 -> (jd, fraction) for sgp4"""
+    days = (np.asarray(times, dtype='datetime64[us]') -
+            np.datetime64('1970-01-01', 'us')) / np.timedelta64(1, 'D')
+    whole = np.floor(days)
+    return whole + UNIX_JD, days - whole
+
+
+def subpoint(times: np.array, teme: np.array) -> tuple:
+    """Geocentric lon, lat (degrees) of TEME positions (km), GMST rotation only"""
+    d = (np.asarray(times, dtype='datetime64[us]') - J2000) / np.timedelta64(1, 'D')
+    gmst = np.deg2rad((18.697374558 + 24.06570982441908 * d) * 15)
+    x, y, z = teme[:, 0], teme[:, 1], teme[:, 2]
+    lon = np.rad2deg(np.arctan2(y, x) - gmst)
+    lat = np.rad2deg(np.arctan2(z, np.hypot(x, y)))
+    return (lon + 180) % 360 - 180, lat
+
+
+def swath_width(mission: str) -> float:
+    """Swath width (km) of the instrument of `mission`, None for non-polar orbiters (GOCI)"""
+    return SWATH_WIDTH.get(SATELLITES[mission]['INSTRUMENT'])
+
+
+def predictor(tle_dir: Path, mission: str, logger):
+    """Overpass of `mission`, None (filter off) when the instrument has no swath width"""
+    if tle_dir is None:
+        return None
+    if swath_width(mission=mission) is None:
+        logger.info(f'Overpass: {SATELLITES[mission]["INSTRUMENT"]} has no swath width, '
+                    f'overpass filter disabled')
+        return None
+    overpass = Overpass(tle_dir=Path(tle_dir), mission=mission)
+    logger.info(f'Overpass: {overpass}')
+    return overpass
+
+
+class Overpass:
+    def __init__(self, tle_dir: Path, mission: str, step: int = TRACK_STEP,
+                 margin: float = SWATH_MARGIN):
+        """
+        tle_dir: directory of <PLATFORM>.tle files
+        mission: key of sutils.SATELLITES
+        """
+        if Satrec is None:
+            raise ImportError('sgp4 is required for the overpass prediction')
+        platform = SATELLITES[mission]['PLATFORM']
+        instrument = SATELLITES[mission]['INSTRUMENT']
+        if instrument not in SWATH_WIDTH:
+            raise ValueError(f'{instrument}: no swath width, not a polar orbiter')
+        files = [file for file in sorted(Path(tle_dir).glob('*'))
+                 if file.stem.upper() == platform.upper() and file.is_file()]
+        if not files:
+            raise FileNotFoundError(f'{platform} TLE file not found in {tle_dir}')
+        self.platform = platform
+        self.sats = read_tle(path=files[0])
+        if not self.sats:
+            raise ValueError(f'{files[0]}: no TLE found')
+        self.epochs = np.array([sat.jdsatepoch + sat.jdsatepochF for sat in self.sats])
+        self.step = step
+        # station to ground track, great-circle distance (km) that can still be covered
+        self.reach = SWATH_WIDTH[instrument] / 2 + margin + TRACK_SPEED * step / 2
+
+    def __str__(self):
+        return f'{self.platform}: {len(self.sats)} TLE | reach {self.reach:.0f} km'
+
+    def track(self, times: np.array) -> tuple:
+        """Ground track lon, lat at `times`, each time with its nearest TLE; NaN if unknown"""
+        jd, fr = julian(times=times)
+        nearest = np.searchsorted((self.epochs[1:] + self.epochs[:-1]) / 2, jd + fr)
+        teme = np.full((jd.size, 3), np.nan)
+        for i in np.unique(nearest):
+            sel = np.flatnonzero(nearest == i)
+            err, r, _ = self.sats[i].sgp4_array(jd[sel], fr[sel])
+            ok = (err == 0) & (np.abs(jd[sel] + fr[sel] - self.epochs[i]) <= MAX_TLE_AGE)
+            teme[sel[ok]] = r[ok]
+        return subpoint(times=times, teme=teme)
+
+    def covered(self, times: np.array, lon: np.array, lat: np.array, hours: float) -> np.array:
+        """
+        Rows with a possible overpass within +/-`hours`; the track is propagated
+        once on a `step` grid over all the days the row windows touch
+        """
+        times = np.asarray(times, dtype='datetime64[us]')
+        window = np.timedelta64(int(hours * 3600 * 1e6), 'us')
+        first = (times - window).astype('datetime64[D]').astype(np.int64)
+        last = (times + window).astype('datetime64[D]').astype(np.int64)
+        days = np.unique(np.concatenate([np.arange(a, b + 1) for a, b in
+                                         np.unique(np.stack([first, last], axis=1), axis=0)]))
+        per_day = 86400 // self.step
+        grid = (days.astype('datetime64[D]').astype('datetime64[s]')[:, None] +
+                np.arange(per_day)[None, :] * np.timedelta64(self.step, 's')).ravel()
+        grid = grid.astype('datetime64[us]')
+        track_lon, track_lat = map(np.deg2rad, self.track(times=grid))
+        # samples of one window, the grid is contiguous within each row window
+        samples = int(2 * hours * 3600 // self.step) + 2
+
+        out = np.ones(times.size, dtype=bool)
+        start = np.searchsorted(grid, times - window)
+        rlon, rlat = np.deg2rad(lon), np.deg2rad(lat)
+        for i in range(0, times.size, ROW_CHUNK):
+            part = slice(i, i + ROW_CHUNK)
+            idx = np.clip(start[part, None] + np.arange(samples)[None, :], 0, grid.size - 1)
+            plat = rlat[part, None]
+            cos_d = (np.sin(plat) * np.sin(track_lat[idx]) + np.cos(plat) *
+                     np.cos(track_lat[idx]) * np.cos(track_lon[idx] - rlon[part, None]))
+            dist = EARTH_RADIUS * np.arccos(np.clip(cos_d, -1, 1))
+            # unknown positions count as covered
+            dist[np.isnan(dist)] = 0
+            out[part] = dist.min(axis=1) <= self.reach
+        return out
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        run planner
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Dry run of a match-up: the input is parsed and pre-filtered and the searches
+are issued (identical searches once), nothing is downloaded. The row-to-granule
+plan is written to a JSON manifest with the estimated cost of the run, the
+unique granules, their published size and the download time at the throughput
+observed by the previous runs (throughput.json in the output directory). A
+later run given the manifest downloads exactly the planned granules, no search.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+import shttp
+
+MANIFEST_VERSION = 1
+THROUGHPUT = 'throughput.json'
+# bytes/s assumed before any download was observed
+DEFAULT_THROUGHPUT = 2 * 1024 * 1024
+
+
+def read_throughput(odir: Path) -> float:
+    """Observed download throughput (bytes/s) of the runs in `odir`"""
+    path = Path(odir).joinpath(THROUGHPUT)
+    if not path.is_file():
+        return DEFAULT_THROUGHPUT
+    with open(path, 'r') as txt:
+        seen = json.load(txt)
+    if seen.get('seconds', 0) <= 0:
+        return DEFAULT_THROUGHPUT
+    return seen['bytes'] / seen['seconds']
+
+
+def save_throughput(odir: Path):
+    """Add the downloads of this run to the throughput of `odir`"""
+    received, elapsed = shttp.throughput()
+    if received == 0:
+        return
+    path = Path(odir).joinpath(THROUGHPUT)
+    seen = {'bytes': 0, 'seconds': 0.}
+    if path.is_file():
+        with open(path, 'r') as txt:
+            seen.update(json.load(txt))
+    seen = {'bytes': seen['bytes'] + received, 'seconds': seen['seconds'] + elapsed}
+    with open(path, 'w') as txt:
+        json.dump(seen, txt)
+
+
+def write_manifest(path: Path, kind: str, **content):
+    """Versioned JSON manifest, written to a .part file and renamed"""
+    path = Path(path)
+    part = path.with_name(f'{path.name}.part')
+    with open(part, 'w') as txt:
+        json.dump({'version': MANIFEST_VERSION,
+                   'kind': kind,
+                   'created': datetime.now().isoformat(timespec='seconds'),
+                   **content}, txt, indent=1)
+    part.replace(path)
+
+
+def read_manifest(path: Path, kind: str) -> dict:
+    with open(path, 'r') as txt:
+        content = json.load(txt)
+    if content.get('kind') != kind:
+        raise ValueError(f'{path}: not a {kind} manifest')
+    if content.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'{path}: manifest version {content.get("version")}, '
+                         f'{MANIFEST_VERSION} expected')
+    return content
+
+
+def fmt_bytes(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB', 'TB'):
+        if size < 1024:
+            break
+        size /= 1024
+    return f'{size:.1f} {unit}'
+
+
+def fmt_hours(seconds: float) -> str:
+    hrs, mnt = int(seconds // 3600), int(seconds % 3600 // 60)
+    return f'{hrs:3} hrs {mnt:3} min'
+
+
+class Manifest:
+    """
+    Row-to-granule plan of a run
+      meta: input file, sensor, data type, search windows, ...
+      rows: input row ID -> {'window': hours, 'granules': [names]}
+      granules: name -> {'href', 'size', 'checksum'}
+      failed: input row IDs whose search failed, not planned
+    """
+    kind = 'plan'
+
+    def __init__(self, meta: dict = None, rows: dict = None, granules: dict = None,
+                 failed: list = None):
+        self.meta = meta or {}
+        self.rows = rows or {}
+        self.granules = granules or {}
+        self.failed = set(failed or [])
+        self.queries = 0
+
+    def add(self, row: int, window: float, entries: list):
+        """Granule entries (search feed entries) planned for input `row`"""
+        names = []
+        for entry in entries:
+            name = entry['producer_granule_id']
+            self.granules.setdefault(name, {'href': entry['links'][0]['href'],
+                                            'size': entry.get('size'),
+                                            'checksum': entry.get('checksum')})
+            names.append(name)
+        self.rows[int(row)] = {'window': window, 'granules': names}
+
+    def windows(self, row: int) -> list:
+        """Search window of a planned row, [] if the plan has no granule for it"""
+        planned = self.rows.get(int(row))
+        return [planned['window']] if planned else []
+
+    def content(self, row: int):
+        """Feed-like content (sget.getfile) of the granules planned for `row`"""
+        planned = self.rows.get(int(row))
+        if not planned:
+            return []
+        entries = []
+        for name in planned['granules']:
+            granule = self.granules[name]
+            entries.append({'producer_granule_id': name,
+                            'links': [{'href': granule['href']}],
+                            'size': granule['size'],
+                            'checksum': tuple(granule['checksum'])
+                            if granule['checksum'] else None})
+        return {'feed': {'entry': entries}}
+
+    def check(self, **meta):
+        """The manifest was planned for this input, sensor, data type and search windows"""
+        for key, val in meta.items():
+            if self.meta.get(key) != val:
+                raise ValueError(f'{self.kind} manifest {key}: '
+                                 f'{self.meta.get(key)} planned, {val} given')
+        windows = self.meta.get('windows') or []
+        stray = {planned['window'] for planned in self.rows.values()} - set(windows)
+        if stray:
+            raise ValueError(f'{self.kind} manifest windows: {sorted(stray)} planned, '
+                             f'not in {windows}')
+
+    def summary(self, throughput: float = DEFAULT_THROUGHPUT) -> dict:
+        """Plan totals; bytes and seconds are None when no granule has a published size"""
+        sizes = [granule['size'] for granule in self.granules.values()]
+        known = [size for size in sizes if size]
+        total = sum(known) if known else None
+        # granules without a published size count as the mean size
+        if known and (len(known) < len(sizes)):
+            total *= len(sizes) / len(known)
+        return {'rows': self.meta.get('rows', 0),
+                'searched': self.meta.get('searched', 0),
+                'queries': self.meta.get('queries', self.queries),
+                'failed': len(self.failed),
+                'granules': len(self.granules),
+                'unknown_size': len(sizes) - len(known),
+                'bytes': None if total is None else int(total),
+                'throughput': throughput,
+                'seconds': None if (total is None) or not throughput else total / throughput,
+                'matchups': len(self.rows)}
+
+    def report(self, throughput: float = DEFAULT_THROUGHPUT) -> str:
+        plan = self.summary(throughput=throughput)
+        size = 'unknown' if plan['bytes'] is None else fmt_bytes(plan['bytes'])
+        hours = 'unknown' if plan['seconds'] is None else fmt_hours(plan['seconds'])
+        return f'   Rows: {plan["rows"]} ({plan["searched"]} searched, ' \
+               f'{plan["failed"]} search failed)\n' \
+               f'Queries: {plan["queries"]}\n' \
+               f'Granule: {plan["granules"]} unique ({plan["unknown_size"]} without size)\n' \
+               f'  Bytes: {size}\n' \
+               f'   Rate: {fmt_bytes(plan["throughput"])}/s\n' \
+               f'   Time: {hours}\n' \
+               f'MatchUp: {plan["matchups"]} row(s) at most'
+
+    def save(self, path: Path, throughput: float = DEFAULT_THROUGHPUT):
+        write_manifest(path=path, kind=self.kind,
+                       meta=self.meta,
+                       summary=self.summary(throughput=throughput),
+                       rows={str(row): val for row, val in self.rows.items()},
+                       failed=sorted(self.failed),
+                       granules=self.granules)
+
+    def granule_names(self, row: int) -> list:
+        planned = self.rows.get(int(row))
+        return planned['granules'] if planned else []
+
+    @classmethod
+    def load(cls, path: Path):
+        content = read_manifest(path=path, kind=cls.kind)
+        return cls(meta=content['meta'],
+                   rows={int(row): val for row, val in content['rows'].items()},
+                   granules=content['granules'],
+                   failed=content.get('failed'))
+
+
+def row_queries(columns: dict, reason, url_parser, windows: list, sat: str, dtype: str,
+                day_index=None, dx: float = .01, dy: float = .01) -> list:
+    """
+    (row ID, [(window, query)]) of the rows left by the pre-filter, in day order,
+    narrowest window first; a query is the CMR/CSW/OBPG URL, or (lon, lat, dt,
+    tim_min, tim_max) when the rows are answered by an ObpgDayIndex. Same queries
+    as smat_main
+    """
+    lons, lats, times, bounds = columns['lon'], columns['lat'], columns['time'], columns['bounds']
+    sst = (sat != 'sgli') and (dtype == 'sst')
+    rows = []
+    for pos in columns['order']:
+        if reason[pos]:
+            continue
+        lon, lat, dt = lons[pos], lats[pos], times[pos].item()
+        if (sat == 'sgli') or (dtype == 'sst'):
+            url_parser.slat, url_parser.elat = lat - dy, lat + dy
+            url_parser.slon, url_parser.elon = lon - dx, lon + dx
+        else:
+            url_parser.slon, url_parser.slat = lon, lat
+        queries = []
+        for window in (windows[-1:] if sst else windows):
+            url_parser.tim_min, url_parser.tim_max = (b[pos].item() for b in bounds[window])
+            if sst:
+                url_parser.tim_min = dt
+            if day_index is not None:
+                queries.append((window, (lon, lat, dt, url_parser.tim_min, url_parser.tim_max)))
+                continue
+            queries.append((window, url_parser.csw_url() if sat == 'sgli' else url_parser.cmr_point()))
+        rows.append((int(pos), queries))
+    return rows
+
+
+def build_plan(rows: list, search, meta: dict, logger) -> Manifest:
+    """
+    Search-only pass over the pre-filtered rows
+      rows: row_queries
+      search: query -> feed-like content, or [] (sget.search / ObpgDayIndex.search)
+    Identical queries are issued once; a row is planned at its first window with granules
+    """
+    start = time.perf_counter()
+    manifest = Manifest(meta=meta)
+    answers = {}
+    for row, queries in rows:
+        for window, query in queries:
+            if query not in answers:
+                manifest.queries += 1
+                try:
+                    content = search(query)
+                    # result pages are pulled here, a lost page fails the row
+                    # NRT SST granules are never downloaded (sget.getfile)
+                    answers[query] = [entry for entry in content['feed']['entry']
+                                      if 'SST.NRT.nc' not in entry['producer_granule_id']] \
+                        if content else []
+                except requests.RequestException as exc:
+                    logger.warning(f'WARNING: Search failed, row {row} not planned.\n{exc}\n')
+                    manifest.failed.add(row)
+                    break
+            if answers[query]:
+                manifest.add(row=row, window=window, entries=answers[query])
+                break
+    manifest.meta.update(searched=len(rows), queries=manifest.queries)
+    logger.info(f'RunPlan: {manifest.queries} queries in {time.perf_counter() - start:.1f} s')
+    return manifest
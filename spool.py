@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        dataset handle pool
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Bounded LRU pool of open granule handles (netCDF4 Dataset, h5py File, pyhdf SD)
+shared by all the readers. Rows, and days, that hit the same granule reuse a
+warm handle: metadata is parsed and the chunk cache filled once. Handles are
+keyed by path, size and mtime, so a granule replaced on disk is reopened.
+
+Readers must leave a pooled handle as they found it (auto mask/scale).
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import h5py
+import netCDF4
+
+try:
+    # optional, MERIS HDF4 granules
+    from pyhdf.SD import (SD, SDC)
+except ImportError:
+    SD = SDC = None
+
+MAX_OPEN = 8
+# netCDF4 chunk cache, per variable
+NC_CACHE_SIZE = 16 * 1024 * 1024
+NC_CACHE_ELEMS = 1009
+# HDF5 chunk cache, per file
+H5_CACHE_SIZE = 64 * 1024 * 1024
+H5_CACHE_SLOTS = 10007
+CACHE_PREEMPTION = .75
+
+
+def open_file(file: Path):
+    """Read-only handle of a .nc (netCDF4), .h5 (HDF5) or .hdf (HDF4) granule"""
+    name = file.name
+    if name.endswith('.h5'):
+        return h5py.File(file, 'r', rdcc_nbytes=H5_CACHE_SIZE, rdcc_nslots=H5_CACHE_SLOTS,
+                         rdcc_w0=CACHE_PREEMPTION)
+    if name.endswith('.hdf'):
+        if SD is None:
+            raise ImportError('pyhdf is required for HDF4 granules')
+        return SD(str(file), SDC.READ)
+    # chunk cache of the variables of the file opened next
+    netCDF4.set_chunk_cache(size=NC_CACHE_SIZE, nelems=NC_CACHE_ELEMS,
+                            preemption=CACHE_PREEMPTION)
+    return netCDF4.Dataset(file, 'r')
+
+
+def close_handle(handle):
+    try:
+        handle.end() if hasattr(handle, 'end') else handle.close()
+    except (OSError, RuntimeError):
+        pass
+
+
+class HandlePool:
+    def __init__(self, max_open: int = MAX_OPEN):
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(file: Path) -> tuple:
+        stat = file.stat()
+        return str(file.absolute()), stat.st_size, stat.st_mtime_ns
+
+    @contextmanager
+    def open(self, file: Path):
+        """
+        Pooled handle of `file`; left open on exit, closed and dropped if the
+        read fails (corrupt granule)
+        """
+        file = Path(file)
+        with self.lock:
+            key = self.key(file=file)
+            handle = self.handles.get(key)
+            if handle is None:
+                self.release(file=file)
+                handle = open_file(file=file)
+                self.handles[key] = handle
+                self.misses += 1
+                while len(self.handles) > self.max_open:
+                    close_handle(self.handles.popitem(last=False)[1])
+            else:
+                self.hits += 1
+            self.handles.move_to_end(key)
+            try:
+                yield handle
+            except BaseException:
+                self.handles.pop(key, None)
+                close_handle(handle)
+                raise
+
+    def release(self, file: Path):
+        """Close the handles of `file` (before deletion or replacement)"""
+        path = str(Path(file).absolute())
+        with self.lock:
+            for key in [key for key in self.handles if key[0] == path]:
+                close_handle(self.handles.pop(key))
+
+    def close(self):
+        with self.lock:
+            while self.handles:
+                close_handle(self.handles.popitem()[1])
+
+    def __str__(self):
+        return f'open {len(self.handles)}/{self.max_open} | hits {self.hits} | misses {self.misses}'
+
+
+POOL = HandlePool()
+
+
+def dataset(file: Path):
+    return POOL.open(file=file)
+
+
+def release(file: Path):
+    POOL.release(file=file)
+
+
+def close():
+    POOL.close()
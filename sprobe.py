@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        remote granule probe
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Two-phase fetch of HTTP-served netCDF4/HDF5 granules. The probe reads only
+the navigation, flags and target pixel window through ranged requests
+(h5py over a block-cached remote file); the granule is downloaded only if
+`min_valid_pixels` can be met at one of the stations.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import io
+import re
+from collections import OrderedDict
+from pathlib import Path
+
+import h5py
+import numpy as np
+import requests
+
+import shttp
+from sflags import bitmask, flag_mask, sensor_key
+
+BLOCK_SIZE = 512 * 1024
+MAX_BLOCKS = 128
+CONTENT_RANGE = re.compile(r'bytes \d+-\d+/(\d+)')
+
+
+class RangeFile(io.RawIOBase):
+    """Read-only, seekable remote file over HTTP range requests with a block cache"""
+
+    def __init__(self, url: str, block_size: int = BLOCK_SIZE, max_blocks: int = MAX_BLOCKS):
+        super().__init__()
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.transferred = 0
+        with shttp.get(url, headers={'Range': 'bytes=0-0'}) as response:
+            fmt = CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+            if (response.status_code != 206) or (fmt is None):
+                raise IOError(f'{url}: server does not honour range requests')
+            self.size = int(fmt.group(1))
+            # later ranges go to the final (post-redirect/login) location
+            self.url = response.url
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def block(self, index: int) -> bytes:
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        with shttp.get(self.url, headers={'Range': f'bytes={start}-{end}'}) as response:
+            if response.status_code != 206:
+                raise IOError(f'{self.url}: range {start}-{end} not honoured')
+            data = response.content
+        self.transferred += len(data)
+        self.blocks[index] = data
+        if len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return data
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), max(0, self.size - self.position))
+        view, done = memoryview(buffer), 0
+        while done < size:
+            index, offset = divmod(self.position + done, self.block_size)
+            data = self.block(index=index)[offset:offset + size - done]
+            view[done:done + len(data)] = data
+            done += len(data)
+        self.position += done
+        return done
+
+
+def sds_key(basename: str, dst) -> str:
+    """Geophysical variable used for the validity test, same choice as FileSanity"""
+    if 'IOP' in basename:
+        return list(dst['geophysical_data'].keys())[0]
+    return 'chlor_a' if 'OC' in basename else 'sst4' if 'SST4' in basename else 'sst'
+
+
+def nearest_pixel(lon: np.array, lat: np.array, plon: float, plat: float) -> tuple:
+    dx = (lon - plon) * np.cos(np.deg2rad(plat))
+    dy = lat - plat
+    return np.unravel_index(np.nanargmin(dx * dx + dy * dy), lat.shape)
+
+
+def valid_pixels(url: str, points: list, window: int, l2_bits=None) -> list:
+    """Number of valid pixels in the `window` x `window` box around each (lon, lat) point"""
+    half = int(window) // 2
+    counts = []
+    with RangeFile(url) as fp, h5py.File(fp, 'r') as dst:
+        lat = dst['navigation_data/latitude'][:]
+        lon = dst['navigation_data/longitude'][:]
+        sds = dst[f'geophysical_data/{sds_key(basename=Path(url).name, dst=dst)}']
+        flags = dst['geophysical_data'].get('l2_flags')
+        mask = bitmask(names=l2_bits, sensor=sensor_key(Path(url).name), flags=flags) \
+            if flags is not None else 0
+        fill = sds.attrs.get('_FillValue')
+
+        for plon, plat in points:
+            row, col = nearest_pixel(lon=lon, lat=lat, plon=plon, plat=plat)
+            rows = slice(max(0, row - half), row + half + 1)
+            cols = slice(max(0, col - half), col + half + 1)
+            data = sds[rows, cols]
+            valid = np.isfinite(data) if fill is None else data != fill
+            if mask:
+                valid &= ~flag_mask(flags=flags[rows, cols], bits=mask)
+            counts.append(int(valid.sum()))
+    return counts
+
+
+def probe_content(content, points: list, out_dir: Path, window: int, min_valid_pixels: int,
+                  l2_bits=None, logger=None):
+    """
+    Drop the entries whose granule cannot meet `min_valid_pixels` at any of `points`.
+    Granules already on disk and granules that cannot be probed are kept
+    """
+    entries = []
+    append = entries.append
+    for entry in content['feed']['entry']:
+        url = entry['links'][0]['href']
+        name = Path(url).name
+        if out_dir.absolute().joinpath(name).is_file() or \
+                not (name.endswith('.nc') or name.endswith('.h5')):
+            append(entry)
+            continue
+        try:
+            counts = valid_pixels(url=url, points=points, window=window, l2_bits=l2_bits)
+        except (IOError, OSError, KeyError, ValueError, requests.RequestException) as exc:
+            if logger:
+                logger.info(f'Probe: {name} | {exc}, full download')
+            append(entry)
+            continue
+        if logger:
+            logger.info(f'Probe: {name} | valid pixels {counts}')
+        if max(counts, default=0) >= min_valid_pixels:
+            append(entry)
+    if len(entries) == 0:
+        return []
+    return {'feed': {'entry': entries}}
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        SGLI L2 reader
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+GCOM-C/SGLI L2 HDF5 granules store Latitude/Longitude as tie-point grids,
+one point every `Resampling_interval` pixels. Stations are located on the
+tie-point grid first, then the full-resolution lat/lon is interpolated
+(bilinear) over the tie-point cells around each station only; the full-scene
+navigation is never built.
+
+Image_data stays in the uint16 DN domain: error, land and valid-range tests are
+integer comparisons and Slope/Offset are applied to the extracted pixels only.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from spool import dataset
+from sprobe import nearest_pixel
+from sstats import gather_windows
+
+IMAGE = 'Image_data'
+GEOMETRY = 'Geometry_data'
+FLAGS = 'QA_flag'
+
+
+def scaled(dst) -> np.array:
+    """Full read of a small dataset with its Slope/Offset applied"""
+    data = dst[:].astype(np.float64)
+    if 'Slope' in dst.attrs:
+        data = data * dst.attrs['Slope'][0] + dst.attrs['Offset'][0]
+    return data
+
+
+def interpolate(tie: np.array, rows: np.array, cols: np.array, interval: int) -> np.array:
+    """Bilinear tie-point interpolation at the full-resolution `rows` x `cols` grid"""
+    fr, fc = np.asarray(rows) / interval, np.asarray(cols) / interval
+    r0 = np.clip(np.floor(fr).astype(np.int64), 0, tie.shape[0] - 2)
+    c0 = np.clip(np.floor(fc).astype(np.int64), 0, tie.shape[1] - 2)
+    wr, wc = (fr - r0)[:, None], (fc - c0)[None, :]
+    r0, c0 = r0[:, None], c0[None, :]
+    return (tie[r0, c0] * (1 - wr) * (1 - wc) + tie[r0 + 1, c0] * wr * (1 - wc) +
+            tie[r0, c0 + 1] * (1 - wr) * wc + tie[r0 + 1, c0 + 1] * wr * wc)
+
+
+class TiePointGrid:
+    def __init__(self, dst: h5py.File, shape: tuple):
+        """
+        dst: open SGLI granule
+        shape: (lines, pixels) of the image data
+        """
+        lat = dst[f'{GEOMETRY}/Latitude']
+        self.interval = int(np.atleast_1d(lat.attrs['Resampling_interval'])[0])
+        self.lat = scaled(lat)
+        self.lon = scaled(dst[f'{GEOMETRY}/Longitude'])
+        self.shape = shape
+
+    def pixel(self, plon: float, plat: float) -> tuple:
+        """Full-resolution row/col nearest to (plon, plat)"""
+        tr, tc = nearest_pixel(lon=self.lon, lat=self.lat, plon=plon, plat=plat)
+        # the tie-point cells around the nearest tie point
+        r0, r1 = max(0, (tr - 1) * self.interval), min(self.shape[0], (tr + 1) * self.interval + 1)
+        c0, c1 = max(0, (tc - 1) * self.interval), min(self.shape[1], (tc + 1) * self.interval + 1)
+        rows, cols = np.arange(r0, r1), np.arange(c0, c1)
+        lat = interpolate(tie=self.lat, rows=rows, cols=cols, interval=self.interval)
+        # longitudes relative to the station, continuous across the dateline
+        rel = (self.lon - plon + 180) % 360 - 180
+        lon = interpolate(tie=rel, rows=rows, cols=cols, interval=self.interval)
+        row, col = nearest_pixel(lon=lon, lat=lat, plon=0, plat=plat)
+        return r0 + row, c0 + col
+
+    def pixels(self, points: list) -> np.array:
+        """(points, 2) row/col of each (lon, lat) point"""
+        return np.array([self.pixel(plon=plon, plat=plat) for plon, plat in points],
+                        dtype=np.int64).reshape(-1, 2)
+
+
+def image_variables(group, variables=None) -> list:
+    """2D Image_data datasets, restricted to `variables` if given"""
+    names = [name for name, var in group.items()
+             if (name != FLAGS) and isinstance(var, h5py.Dataset) and (var.ndim == 2)]
+    if not variables or variables in ('*', ['*']):
+        return names
+    if isinstance(variables, str):
+        variables = variables.split(',')
+    return [name for name in names if name in variables]
+
+
+def dn_attr(var, name: str, default=None):
+    return np.atleast_1d(var.attrs[name])[0] if name in var.attrs else default
+
+
+def valid_dn(var, dn: np.array) -> np.array:
+    """Valid pixels of the DNs `dn` read from `var`, integer comparisons only"""
+    valid = np.ones(dn.shape, dtype=bool)
+    for name in ('Error_DN', 'Land_DN', 'Cloud_error_DN', 'Retrieval_error_DN'):
+        value = dn_attr(var=var, name=name)
+        if value is not None:
+            valid &= dn != value
+    low = dn_attr(var=var, name='Minimum_valid_DN')
+    high = dn_attr(var=var, name='Maximum_valid_DN')
+    if low is not None:
+        valid &= dn >= low
+    if high is not None:
+        valid &= dn <= high
+    return valid
+
+
+def to_geophysical(var, dn: np.array, valid: np.array) -> np.array:
+    """float32 values, Slope/Offset applied to the valid DNs only, NaN elsewhere"""
+    out = np.full(dn.shape, np.nan, dtype=np.float32)
+    values = dn[valid].astype(np.float32)
+    if 'Slope' in var.attrs:
+        values = values * np.float32(dn_attr(var=var, name='Slope')) + \
+                 np.float32(dn_attr(var=var, name='Offset'))
+    out[valid] = values
+    return out
+
+
+def read_windows(var, pixels: np.array, window: int) -> np.array:
+    """Geophysical windows of an Image_data dataset, invalid DNs as NaN"""
+    fill = dn_attr(var=var, name='Error_DN', default=np.iinfo(var.dtype).max
+                   if np.issubdtype(var.dtype, np.integer) else np.nan)
+    dn = gather_windows(var=var, pixels=pixels, window=window, fill=fill, dtype=var.dtype)
+    return to_geophysical(var=var, dn=dn, valid=valid_dn(var=var, dn=dn))
+
+
+def read_dn(file: Path, key: str) -> np.ma.masked_array:
+    """Full scene of /Image_data/`key` as a DN masked array (FileSanity)"""
+    with dataset(file=file) as dst:
+        var = dst[f'{IMAGE}/{key}']
+        dn = var[:]
+        return np.ma.masked_array(dn, mask=~valid_dn(var=var, dn=dn), copy=False)
+
+
+def extract_windows(file: Path, points: list, window: int, variables=None):
+    """Same as sextract.extract_windows, for SGLI L2 HDF5 granules"""
+    with dataset(file=file) as dst:
+        image = dst[IMAGE]
+        names = image_variables(group=image, variables=variables)
+        shape = image[names[0] if names else FLAGS].shape
+        pixels = TiePointGrid(dst=dst, shape=shape).pixels(points=points)
+
+        windows = {name: read_windows(var=image[name], pixels=pixels, window=window)
+                   for name in names}
+        flags = None
+        if FLAGS in image:
+            flags = gather_windows(var=image[FLAGS], pixels=pixels, window=window, fill=0,
+                                   dtype=np.int32)
+    return windows, flags, pixels
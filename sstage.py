@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        staged pipeline
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Search, fetch and extract as separate runs, on one or several machines,
+exchanging versioned JSON manifests (splan.MANIFEST_VERSION)
+  search   python pyget.py ... --plan=plan.json
+           row-to-granule plan (splan.Manifest)
+  fetch    python sstage.py fetch --manifest=plan.json --granule_dir=DIR
+           granules of the plan, DIR/inventory.json lists the fetched granules
+  extract  python sstage.py extract --manifest=plan.json --inventory=DIR/inventory.json ...
+           smat_main on the fetched granules, results.json lists the rows done
+
+Every stage is restartable: fetch saves the inventory after each granule and
+skips the fetched ones, extract saves the results after each day and skips the
+rows done. Extract only takes the rows whose granules are all fetched (or given
+up), so it can run, and be rerun, while fetch is still going.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from splan import (Manifest, read_manifest, save_throughput, write_manifest)
+
+# download attempts over all the fetch runs before a granule is given up
+MAX_ATTEMPTS = 3
+INVENTORY = 'inventory.json'
+RESULTS = 'results.json'
+
+
+class Inventory:
+    """
+    Fetched granules of a plan, files relative to the inventory directory so
+    that the directory can be moved or shared with the extract nodes
+      granules: name -> {'file', 'status': 'ok'|'failed', 'attempts'}
+    """
+    kind = 'inventory'
+
+    def __init__(self, path: Path, plan: str = None, granules: dict = None):
+        self.path = Path(path)
+        self.root = self.path.parent
+        self.plan = plan
+        self.granules = granules or {}
+
+    @classmethod
+    def open(cls, path: Path, plan: str = None):
+        """Inventory at `path`, empty if not written yet"""
+        path = Path(path)
+        if not path.is_file():
+            return cls(path=path, plan=plan)
+        content = read_manifest(path=path, kind=cls.kind)
+        if plan and content['plan'] and (content['plan'] != plan):
+            raise ValueError(f'{path}: inventory of {content["plan"]}, not {plan}')
+        return cls(path=path, plan=content['plan'], granules=content['granules'])
+
+    def save(self):
+        ok = sum(granule['status'] == 'ok' for granule in self.granules.values())
+        write_manifest(path=self.path, kind=self.kind, plan=self.plan,
+                       summary={'granules': len(self.granules), 'ok': ok,
+                                'failed': len(self.granules) - ok},
+                       granules=self.granules)
+
+    def add(self, name: str, file: Path):
+        granule = self.granules.setdefault(name, {'file': Path(file).name, 'attempts': 0})
+        granule['attempts'] += 1
+        granule['status'] = 'ok' if Path(file).is_file() else 'failed'
+
+    def fetched(self, name: str) -> bool:
+        granule = self.granules.get(name)
+        return (granule is not None) and (granule['status'] == 'ok') and \
+            self.root.joinpath(granule['file']).is_file()
+
+    def final(self, name: str) -> bool:
+        """Fetched, or given up after MAX_ATTEMPTS"""
+        return self.fetched(name=name) or \
+            (self.granules.get(name, {}).get('attempts', 0) >= MAX_ATTEMPTS)
+
+    def local(self, content) -> list:
+        """Local files of the fetched granules of a feed-like content"""
+        if not content:
+            return []
+        return [self.root.joinpath(self.granules[entry['producer_granule_id']]['file'])
+                for entry in content['feed']['entry']
+                if self.fetched(name=entry['producer_granule_id'])]
+
+
+class Results:
+    """
+    Extracted rows of a plan
+      rows: input row ID -> output file the row was written to
+    """
+    kind = 'results'
+
+    def __init__(self, path: Path, plan: str = None, rows: dict = None):
+        self.path = Path(path)
+        self.plan = plan
+        self.rows = rows or {}
+
+    @classmethod
+    def open(cls, path: Path, plan: str = None):
+        path = Path(path)
+        if not path.is_file():
+            return cls(path=path, plan=plan)
+        content = read_manifest(path=path, kind=cls.kind)
+        if plan and content['plan'] and (content['plan'] != plan):
+            raise ValueError(f'{path}: results of {content["plan"]}, not {plan}')
+        return cls(path=path, plan=content['plan'],
+                   rows={int(row): val for row, val in content['rows'].items()})
+
+    def add(self, row_ids, ofile: Path):
+        for row in row_ids:
+            self.rows[int(row)] = Path(ofile).name
+
+    def save(self):
+        write_manifest(path=self.path, kind=self.kind, plan=self.plan,
+                       summary={'rows': len(self.rows)},
+                       rows={str(row): val for row, val in self.rows.items()})
+
+
+def ready_rows(row_ids: np.array, manifest: Manifest, inventory: Inventory,
+               results: Results) -> np.array:
+    """Rows not extracted yet whose planned granules are all fetched or given up"""
+    return np.array([(int(row) not in results.rows) and
+                     all(inventory.final(name=name)
+                         for name in manifest.granule_names(row=row))
+                     for row in row_ids], dtype=bool)
+
+
+def fetch(manifest: Manifest, inventory: Inventory, logger):
+    """Download the planned granules missing from the inventory, in plan (day) order"""
+    from sget import close_gportal, wget
+
+    case = 'csw' if manifest.meta['sat'] == 'sgli' else 'cmr'
+    todo = [name for name in manifest.granules if not inventory.final(name=name)]
+    logger.info(f'Fetch: {len(todo)} of {len(manifest.granules)} granule(s) to download')
+    for i, name in enumerate(todo):
+        granule = manifest.granules[name]
+        logger.info(f'Fetch: {i + 1} OUT-OF {len(todo)}\n{name}')
+        local = wget(url=granule['href']
+                     , out_dir=inventory.root
+                     , case=case
+                     , logger=logger
+                     , checksum=tuple(granule['checksum']) if granule['checksum'] else None
+                     , size=granule['size'])
+        inventory.add(name=name, file=local)
+        inventory.save()
+    close_gportal()
+    save_throughput(odir=inventory.root)
+    failed = sum(not inventory.fetched(name=name) for name in manifest.granules)
+    logger.info(f'Fetch: {len(manifest.granules) - failed} granule(s) in {inventory.path}, '
+                f'{failed} missing')
+
+
+def cli_main():
+    import argparse
+    from pyget import get_logger
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description=__doc__.split('Comments/questions')[0])
+    stages = parser.add_subparsers(dest='stage', required=True)
+
+    get = stages.add_parser('fetch', formatter_class=argparse.RawTextHelpFormatter,
+                            help='download the granules of a plan')
+    get.add_argument('--manifest', type=str, required=True, help='''\
+      Plan manifest written by pyget.py --plan
+      ''')
+    get.add_argument('--granule_dir', type=str, default=os.getcwd(), help=f'''\
+      OPTIONAL: download directory, the inventory is saved there as {INVENTORY}
+      ''')
+
+    ext = stages.add_parser('extract', formatter_class=argparse.RawTextHelpFormatter,
+                            help='match-ups of the fetched granules')
+    ext.add_argument('--manifest', type=str, required=True, help='''\
+      Plan manifest written by pyget.py --plan
+      ''')
+    ext.add_argument('--inventory', type=str, required=True, help='''\
+      Inventory written by the fetch stage
+      ''')
+    ext.add_argument('--text_file', type=str, required=True, help='''\
+      In-situ input file the plan was made for
+      ''')
+    ext.add_argument('--output_dir', type=str, default=os.getcwd(), help=f'''\
+      OPTIONAL: output directory, the results manifest is saved there as {RESULTS}
+      ''')
+    ext.add_argument('--ofile', type=str, default=None, help='''\
+      OPTIONAL: match-up file name, default <text_file>_<sat>_<data_type>_matchup.csv
+      ''')
+    ext.add_argument('--variables', type=str, nargs='+', required=True)
+    ext.add_argument('--pixel_window_size', type=int, required=True)
+    ext.add_argument('--min_valid_pixels', type=int, required=True)
+    ext.add_argument('--l2_bits', type=str, required=True)
+    ext.add_argument('--sst_quality_level', type=int, default=None)
+    ext.add_argument('--sst_flag', type=str, default='n', choices=['4', 'd', 'n'])
+    ext.add_argument('--user', type=str, default=os.environ.get('USER', 'None'))
+    ext.add_argument('--email', type=str, default='')
+    ext.add_argument('--host', type=str, default='')
+
+    args = parser.parse_args()
+    logger = get_logger()
+    manifest = Manifest.load(path=Path(args.manifest))
+    plan = Path(args.manifest).name
+
+    if args.stage == 'fetch':
+        inventory = Inventory.open(path=Path(args.granule_dir).joinpath(INVENTORY), plan=plan)
+        inventory.root.mkdir(parents=True, exist_ok=True)
+        fetch(manifest=manifest, inventory=inventory, logger=logger)
+        return
+
+    from main import smat_main
+
+    meta = manifest.meta
+    odir = Path(args.output_dir)
+    odir.mkdir(parents=True, exist_ok=True)
+    ofile = odir.joinpath(args.ofile or f'{Path(args.text_file).stem}_{meta["sat"]}_'
+                                        f'{meta["data_type"]}_matchup.csv')
+    # the search windows (time_window_step) are those of the plan meta, see smat_main
+    parse_vars = {'sat': [meta['sat']]
+                  , 'data_type': [meta['data_type']]
+                  , 'max_time_diff': [meta['max_time_diff']]
+                  , 'sst_flag': [args.sst_flag]
+                  , 'variables': args.variables
+                  , 'pixel_window_size': [args.pixel_window_size]
+                  , 'min_valid_pixels': [args.min_valid_pixels]
+                  , 'l2_bits': [args.l2_bits]
+                  , 'sst_quality_level': [args.sst_quality_level]
+                  , 'user': [args.user]
+                  , 'email': [args.email]
+                  , 'host': [args.host]
+                  , 'manifest': [args.manifest]
+                  , 'inventory': [args.inventory]
+                  , 'results': [str(odir.joinpath(RESULTS))]}
+    smat_main(ifile=Path(args.text_file)
+              , ofile=ofile
+              , odir=odir
+              , parse_vars=parse_vars
+              , debug=False
+              , logger=logger)
+
+
+if __name__ == "__main__":
+    sys.exit(cli_main())
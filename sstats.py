@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        window statistics engine
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Batched match-up statistics. The windows of all the rows and variables of a
+granule are gathered with one fancy-indexing call into a (rows, vars, N, N)
+array, the l2_flags mask is applied with a single bitwise operation and the
+statistics are reduced along the window axes in one vectorized call.
+The numba backend (optional) computes the same statistics, 1.5-sigma filtered
+mean included, in one compiled pass over the valid pixels of each window.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from sflags import flag_mask
+
+try:
+    # optional, compiled statistics
+    import numba
+except ImportError:
+    numba = None
+
+STATS = ('Median', 'Mean', 'Std', 'CV', 'FilteredMean', 'ValidPixels')
+# filtered mean keeps pixels within mean +/- FILTER_STD * std (Bailey & Werdell, 2006)
+FILTER_STD = 1.5
+
+
+def gather_windows(var, pixels: np.array, window: int, fill=np.nan, dtype=np.float32) -> np.array:
+    """
+    N x N windows of the 2D `var` (array or netCDF/HDF5 variable) centred at
+    each row/col of `pixels`, (points, N, N). Only the bounding box of the
+    windows is read; pixels outside the swath are set to `fill`
+    """
+    pixels = np.asarray(pixels, dtype=np.int64).reshape(-1, 2)
+    size = int(window)
+    half = size // 2
+    if pixels.shape[0] == 0:
+        return np.empty((0, size, size), dtype=dtype)
+
+    (r0, c0), (r1, c1) = pixels.min(axis=0) - half, pixels.max(axis=0) + half + 1
+    rows = slice(max(0, r0), min(var.shape[0], r1))
+    cols = slice(max(0, c0), min(var.shape[1], c1))
+    box = np.full((r1 - r0, c1 - c0), fill, dtype=dtype)
+    data = var[rows, cols]
+    if np.ma.isMaskedArray(data):
+        data = data.astype(dtype).filled(fill)
+    box[rows.start - r0:rows.stop - r0, cols.start - c0:cols.stop - c0] = data
+
+    view = sliding_window_view(box, (size, size))
+    return view[pixels[:, 0] - half - r0, pixels[:, 1] - half - c0]
+
+
+def stack(windows: dict, variables: list = None) -> tuple:
+    """(rows, vars, N, N) float32 array of the `windows` dict and the variable order"""
+    variables = list(windows) if variables is None else list(variables)
+    return np.stack([windows[name] for name in variables], axis=1).astype(np.float32), variables
+
+
+def valid_mask(data: np.array, flags: np.array = None, mask: int = 0) -> np.array:
+    """
+    Finite pixels with none of the `mask` bits set; (rows, N, N) flags are
+    broadcast over the vars axis of (rows, vars, N, N) data
+    """
+    valid = np.isfinite(data)
+    if mask and (flags is not None):
+        clear = ~flag_mask(flags=flags, bits=mask)
+        valid &= clear[:, None] if data.ndim == clear.ndim + 1 else clear
+    return valid
+
+
+def numpy_stats(data: np.array, valid: np.array) -> dict:
+    count = valid.sum(axis=(-2, -1))
+    values = np.where(valid, data, np.nan)
+    # all-NaN windows are expected, their statistics are NaN
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        mean = np.nanmean(values, axis=(-2, -1))
+        std = np.nanstd(values, axis=(-2, -1), ddof=1)
+        median = np.nanmedian(values, axis=(-2, -1))
+        keep = np.abs(values - mean[..., None, None]) <= FILTER_STD * std[..., None, None]
+        filtered = np.nanmean(np.where(keep, values, np.nan), axis=(-2, -1))
+    return {'Median': median, 'Mean': mean, 'Std': std, 'FilteredMean': filtered,
+            'ValidPixels': count}
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def stats_kernel(values, valid, out):
+        # values/valid (windows, N * N), out (windows, 5): median, mean, std, filtered, count
+        for i in numba.prange(values.shape[0]):
+            buf = values[i][valid[i]]
+            n = buf.size
+            out[i, 4] = n
+            if n == 0:
+                out[i, :4] = np.nan
+                continue
+            mean = buf.mean()
+            std = np.sqrt(((buf - mean) ** 2).sum() / (n - 1)) if n > 1 else np.nan
+            keep = buf[np.abs(buf - mean) <= FILTER_STD * std]
+            out[i, 0] = np.median(buf)
+            out[i, 1] = mean
+            out[i, 2] = std
+            out[i, 3] = keep.mean() if keep.size else np.nan
+
+
+def numba_stats(data: np.array, valid: np.array) -> dict:
+    lead = data.shape[:-2]
+    values = np.ascontiguousarray(data, dtype=np.float64).reshape(-1, data.shape[-2] * data.shape[-1])
+    out = np.empty((values.shape[0], 5), dtype=np.float64)
+    stats_kernel(values, np.ascontiguousarray(valid).reshape(values.shape), out)
+    out = out.reshape(lead + (5,))
+    return {'Median': out[..., 0], 'Mean': out[..., 1], 'Std': out[..., 2],
+            'FilteredMean': out[..., 3], 'ValidPixels': out[..., 4].astype(np.int64)}
+
+
+def window_stats(data: np.array, valid: np.array, min_valid_pixels: int = 1,
+                 backend: str = None) -> dict:
+    """
+    Statistics of (..., N, N) windows over the valid pixels, reduced along the
+    window axes; windows below `min_valid_pixels` get NaN.
+    backend: 'numpy', 'numba' or None (numba when installed)
+    """
+    if backend is None:
+        backend = 'numpy' if numba is None else 'numba'
+    if (backend == 'numba') and (numba is None):
+        raise ImportError('numba is required for the numba statistics backend')
+    stats = numba_stats(data=data, valid=valid) if backend == 'numba' else \
+        numpy_stats(data=data, valid=valid)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['CV'] = stats['Std'] / stats['Mean']
+    low = stats['ValidPixels'] < min_valid_pixels
+    for key in STATS[:-1]:
+        stats[key] = np.where(low, np.nan, stats[key])
+    return {key: stats[key] for key in STATS}
+
+
+def batch_stats(windows: dict, flags: np.array = None, mask: int = 0, min_valid_pixels: int = 1,
+                variables: list = None, backend: str = None) -> dict:
+    """
+    Statistics of every row and variable of a granule at once
+
+    Returns
+    -------
+        dict
+            variable -> {statistic -> (rows,) array}
+    """
+    data, variables = stack(windows=windows, variables=variables)
+    valid = valid_mask(data=data, flags=flags, mask=mask)
+    stats = window_stats(data=data, valid=valid, min_valid_pixels=min_valid_pixels,
+                         backend=backend)
+    return {name: {key: val[:, i] for key, val in stats.items()}
+            for i, name in enumerate(variables)}
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""
+Name:        regional subset store
+Purpose:     Level-2 Data Match-up tool
+
+authorship
+__author__     = "Eligio Maure"
+__license__    = ""
+__version__    = "1.0.1"
+__maintainer__ = "Eligio Maure"
+__email__      = "maure at npec dot or dot jp"
+
+Subset-and-keep: before a day's granules are deleted, all the variables and
+navigation inside a margin around the matched rows are written to a small
+netCDF4 file with the granule's name and group/variable layout. Later runs
+(other pixel_window_size, l2_bits or variables) read the subset instead of
+downloading the granule again.
+
+Comments/questions:
+  email: maure at npec dot or dot jp (E. R. Maure)
+2020/10/07
+"""
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+from netCDF4 import Dataset
+
+from spool import (dataset, release)
+from sprobe import nearest_pixel
+
+# a stored subset answers a point at most this many pixel spacings from its nearest pixel
+MAX_PIXEL_DISTANCE = 1.5
+# dimensions sliced by the row/column window, everything else is copied whole
+ROW_DIMS = ('number_of_lines',)
+COL_DIMS = ('pixels_per_line', 'pixel_control_points')
+
+
+def copy_group(src, dst, rows: slice, cols: slice):
+    dst.setncatts({key: src.getncattr(key) for key in src.ncattrs()})
+    for name, dim in src.dimensions.items():
+        size = len(dim)
+        if name in ROW_DIMS:
+            size = len(range(size)[rows])
+        if name in COL_DIMS:
+            size = len(range(size)[cols])
+        dst.createDimension(name, None if dim.isunlimited() else size)
+
+    for name, var in src.variables.items():
+        fill = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+        out = dst.createVariable(name, var.datatype, var.dimensions, zlib=True,
+                                 fill_value=fill)
+        out.setncatts({key: var.getncattr(key) for key in var.ncattrs()
+                       if key != '_FillValue'})
+        var.set_auto_maskandscale(False)
+        out.set_auto_maskandscale(False)
+        index = tuple(rows if dim in ROW_DIMS else cols if dim in COL_DIMS else slice(None)
+                      for dim in var.dimensions)
+        out[...] = var[index] if len(index) else var[...]
+        # pooled handle, back to the default
+        var.set_auto_maskandscale(True)
+
+    for name, group in src.groups.items():
+        copy_group(src=group, dst=dst.createGroup(name), rows=rows, cols=cols)
+
+
+def lon_box(lon: np.array) -> tuple:
+    """(west, east) of longitudes, west > east when the region crosses the dateline"""
+    lon = lon[np.isfinite(lon)]
+    west, east = float(lon.min()), float(lon.max())
+    if (east - west > 180) and (lon > 0).any() and (lon < 0).any():
+        # the short way round
+        west, east = float(lon[lon > 0].min()), float(lon[lon < 0].max())
+    return west, east
+
+
+def in_lon(lon: float, west: float, east: float) -> bool:
+    if west <= east:
+        return west <= lon <= east
+    return (lon >= west) or (lon <= east)
+
+
+def distance(lon0, lat0, lon1, lat1):
+    """Equirectangular distance (degrees of latitude), longitudes across +/-180 wrapped"""
+    dlon = (np.asarray(lon1) - lon0 + 180) % 360 - 180
+    return np.hypot(dlon * np.cos(np.deg2rad(lat0)), np.asarray(lat1) - lat0)
+
+
+def on_footprint(lat: np.array, lon: np.array, plon: float, plat: float, pixel: tuple) -> bool:
+    """The point lies on the grid: its nearest `pixel` is within MAX_PIXEL_DISTANCE spacings"""
+    row, col = (int(p) for p in pixel)
+    if not (np.isfinite(lat[row, col]) and np.isfinite(lon[row, col])):
+        return False
+    rows = slice(max(0, row - 1), row + 2)
+    cols = slice(max(0, col - 1), col + 2)
+    spacing = distance(lon0=lon[row, col], lat0=lat[row, col],
+                       lon1=lon[rows, cols], lat1=lat[rows, cols])
+    spacing = np.nanmax(spacing) if np.isfinite(spacing).any() else 0.
+    return distance(lon0=plon, lat0=plat, lon1=lon[row, col], lat1=lat[row, col]) <= \
+        MAX_PIXEL_DISTANCE * spacing
+
+
+class SubsetStore:
+    def __init__(self, root: Path, margin: int = 50, nav_cache=None):
+        self.root = Path(root)
+        self.margin = int(margin)
+        # snav.NavCache, point-to-pixel lookups of the granules being kept
+        self.nav_cache = nav_cache
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.root.joinpath('index.json')
+        self.lock = threading.Lock()
+        self.index = {}
+        if self.index_file.is_file():
+            with open(self.index_file, 'r') as txt:
+                self.index = json.load(txt)
+
+    def save_index(self):
+        with open(self.index_file, 'w') as txt:
+            json.dump(self.index, txt, indent=1)
+
+    def region(self, name: str) -> tuple:
+        """(rows, cols) slices of the stored subset of granule `name`, None if not stored"""
+        subset = self.root.joinpath(name)
+        if not subset.is_file():
+            return None
+        with Dataset(subset, 'r') as dst:
+            bounds = [tuple(map(int, dst.getncattr(key).split(':')))
+                      for key in ('subset_rows', 'subset_cols')]
+        return tuple(slice(*bound) for bound in bounds)
+
+    def write(self, file: Path, points: list, logger=None) -> Path:
+        """
+        Keep the region of `file` around the (lon, lat) `points`, merged (union
+        box) with the region already stored for the granule; returns the subset path
+        """
+        file = Path(file)
+        subset = self.root.joinpath(file.name)
+        if file in self:
+            return file
+        if not file.name.endswith('.nc'):
+            if logger:
+                logger.info(f'SubsetStore: {file.name} not netCDF4, not kept')
+            return None
+
+        index = self.nav_cache.get(file=file) if self.nav_cache is not None else None
+        with dataset(file=file) as src:
+            if index is not None:
+                lat, lon = index.lat, index.lon
+                pixels = index.pixels(points=points)
+            else:
+                nav = src.groups['navigation_data']
+                lat = nav['latitude'][:].filled(np.nan)
+                lon = nav['longitude'][:].filled(np.nan)
+                pixels = np.array([nearest_pixel(lon=lon, lat=lat, plon=plon, plat=plat)
+                                   for plon, plat in points])
+            (r0, c0), (r1, c1) = pixels.min(axis=0), pixels.max(axis=0)
+            rows = slice(max(0, r0 - self.margin), r1 + self.margin + 1)
+            cols = slice(max(0, c0 - self.margin), c1 + self.margin + 1)
+            # stations elsewhere in the granule keep their region
+            stored = self.region(name=file.name)
+            if stored is not None:
+                rows = slice(min(rows.start, stored[0].start), max(rows.stop, stored[0].stop))
+                cols = slice(min(cols.start, stored[1].start), max(cols.stop, stored[1].stop))
+
+            part = subset.with_name(f'{subset.name}.part')
+            with Dataset(part, 'w', format='NETCDF4') as dst:
+                copy_group(src=src, dst=dst, rows=rows, cols=cols)
+                dst.setncattr('subset_rows', f'{rows.start}:{rows.stop}')
+                dst.setncattr('subset_cols', f'{cols.start}:{cols.stop}')
+            release(file=subset)
+            part.replace(subset)
+
+            box = lat[rows, cols], lon[rows, cols]
+        west, east = lon_box(lon=np.asarray(box[1]))
+        with self.lock:
+            self.index[file.name] = [west, float(np.nanmin(box[0])),
+                                     east, float(np.nanmax(box[0]))]
+            self.save_index()
+        if logger:
+            logger.info(f'SubsetStore: {subset.name} | rows {rows.start}:{rows.stop} '
+                        f'cols {cols.start}:{cols.stop} | {subset.stat().st_size} bytes')
+        return subset
+
+    def get(self, name: str, lon: float, lat: float) -> Path:
+        """
+        Stored subset of granule `name` that covers (lon, lat), None otherwise; the
+        bounding box (west > east across the dateline) is a first test, the point
+        must then lie on the stored pixels, not in a corner of the box off the swath
+        """
+        box = self.index.get(name)
+        subset = self.root.joinpath(name)
+        if (box is None) or not subset.is_file():
+            return None
+        west, south, east, north = box
+        if not ((south <= lat <= north) and in_lon(lon=lon, west=west, east=east)):
+            return None
+        index = self.nav_cache.get(file=subset) if self.nav_cache is not None else None
+        if index is not None:
+            nav_lat, nav_lon = np.asarray(index.lat), np.asarray(index.lon)
+            pixel = index.pixel(plon=lon, plat=lat)
+        else:
+            with dataset(file=subset) as dst:
+                nav = dst.groups['navigation_data']
+                nav_lat = nav['latitude'][:].filled(np.nan)
+                nav_lon = nav['longitude'][:].filled(np.nan)
+            pixel = nearest_pixel(lon=nav_lon, lat=nav_lat, plon=lon, plat=lat)
+        if on_footprint(lat=nav_lat, lon=nav_lon, plon=lon, plat=lat, pixel=pixel):
+            return subset
+        return None
+
+    def split(self, content, lon: float, lat: float):
+        """Split search content into (content still to download, stored subsets)"""
+        entries, stored = [], []
+        for entry in content['feed']['entry']:
+            subset = self.get(name=Path(entry['links'][0]['href']).name, lon=lon, lat=lat)
+            if subset is None:
+                entries.append(entry)
+            else:
+                stored.append(subset)
+        return ({'feed': {'entry': entries}} if len(entries) else []), stored
+
+    def __contains__(self, file: Path):
+        return Path(file).parent.absolute() == self.root.absolute()
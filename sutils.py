@@ -24,17 +24,18 @@ import os
 import re
 import subprocess
 import sys
-from datetime import datetime
+from datetime import (datetime, timedelta)
 from pathlib import Path
 
-import h5py
 import numpy as np
 from dateutil.parser import parse
-from netCDF4 import (Dataset)
 from netCDF4 import date2num
 from numpy.ma import masked_array
 from pandas import DataFrame
-from pyhdf.SD import (SD, SDC)
+
+from sextract import extract_windows
+from spool import (dataset, release)
+from ssgli import read_dn
 
 # dictionary of lists of CMR platform, instrument, collection names
 SATELLITES = {
@@ -121,6 +122,87 @@ def skip(mission: str, day: int):
            (day > SATELLITES[mission]['PERIOD_END'])
 
 
+def time_windows(max_time_diff: float, step: float = None):
+    """
+    Search windows (hours) tried in turn by the adaptive time-window mode.
+    Windows widen by `step` up to `max_time_diff`; without a step
+    the single +/-`max_time_diff` window is returned
+    :param max_time_diff:
+    :param step:
+    :return:
+    """
+    if (step is None) or (step <= 0) or (step >= max_time_diff):
+        return [max_time_diff]
+    # integer steps, float steps can land on max_time_diff (36 / .3)
+    windows = (np.arange(1, np.ceil(max_time_diff / step)) * step).round(6)
+    return windows[windows < max_time_diff].tolist() + [max_time_diff]
+
+
+# granule start time in the file name, OBPG (new and old) and SGLI
+GRANULE_TIME = ((re.compile(r'\.(\d{8}T\d{6})\.'), '%Y%m%dT%H%M%S'),
+                (re.compile(r'^[A-Z](\d{13})\.'), '%Y%j%H%M%S'),
+                (re.compile(r'^GC1SG1_(\d{12})'), '%Y%m%d%H%M'))
+# longest granule duration, hours
+GRANULE_SPAN = 1.
+
+
+def granule_time(name: str):
+    """Start time of a granule from its name, None if unknown"""
+    for regex, fmt in GRANULE_TIME:
+        match = regex.search(name)
+        if match:
+            return datetime.strptime(match.group(1), fmt)
+    return None
+
+
+def row_columns(data_frame: DataFrame, mission: str, windows: list) -> dict:
+    """
+    Columnar view of the in-situ rows for the day loops: datetime64 times and
+    days, the stable day order, float lon/lat, the out-of-mission mask and
+    the +/-window search bounds of every row
+    """
+    times = data_frame['Datetime'].to_numpy(dtype='datetime64[us]')
+    days = times.astype('datetime64[D]')
+    ordinal = days.astype(np.int64) + datetime(1970, 1, 1).toordinal()
+    bounds = {}
+    for window in windows:
+        delta = np.timedelta64(int(round(window * 3600 * 1e6)), 'us')
+        bounds[window] = times - delta, times + delta
+    return {'time': times,
+            'day': days,
+            'order': np.argsort(days, kind='stable'),
+            'lon': np.asarray(data_frame['Lon'], dtype=np.float64),
+            'lat': np.asarray(data_frame['Lat'], dtype=np.float64),
+            'skip': (SATELLITES[mission]['PERIOD_START'] > ordinal) |
+                    (ordinal > SATELLITES[mission]['PERIOD_END']),
+            'bounds': bounds}
+
+
+class GranuleRefs:
+    """
+    Cross-day references of the downloaded granules: the rows of the input file
+    whose +/-max_time_diff search window overlaps a granule
+    """
+
+    def __init__(self, times, max_time_diff: float, span: float = GRANULE_SPAN):
+        self.times = np.sort(np.asarray(times, dtype='datetime64[s]'))
+        self.before = np.timedelta64(int(max_time_diff * 3600), 's')
+        self.after = self.before + np.timedelta64(int(span * 3600), 's')
+
+    def count(self, file: Path, after) -> int:
+        """Rows at or after `after` (datetime64) that may use `file`"""
+        start = granule_time(name=Path(file).name)
+        if start is None:
+            return 0
+        start = np.datetime64(start, 's')
+        lo = max(start - self.before, np.datetime64(after, 's'))
+        hi = start + self.after
+        if lo > hi:
+            return 0
+        return int(np.searchsorted(self.times, hi, side='right') -
+                   np.searchsorted(self.times, lo, side='left'))
+
+
 class MatchUpError(Exception):
     """A custom exception used to report errors"""
 
@@ -154,6 +236,16 @@ class UrlParser:
             if self.sst_flag in ('3', '4'):
                 self.short_name = f'{platform}_{instrument}*.L2.SST{self.sst_flag}.nc'
 
+    def set_time_window(self, dt: datetime, hours: float):
+        """Centre a +/-`hours` search window on the in-situ time `dt`"""
+        self.tim_min = dt - timedelta(hours=hours)
+        self.tim_max = dt + timedelta(hours=hours)
+        return self
+
+    def ocbrowser_search(self):
+        """SST searches go to the OBPG browser, except JPSS1/ENVISAT found through CMR"""
+        return (self.platform not in ('JPSS1', 'ENVISAT', 'GCOM-C')) and ('SST' in self.short_name)
+
     def cmr_point(self):
         if self.platform in ('JPSS1', 'ENVISAT'):
             return "https://cmr.earthdata.nasa.gov/search/granules.json?page_size=2000" \
@@ -258,9 +350,20 @@ class UrlParser:
         if self.data_type == 'iop':
             raise MatchUpError('IOP not defined for SGLI')
 
-    def ocbrowser(self):
-        day = date2num(self.tim_min, calendar=u'gregorian',
+    def cmr_day_coverage(self, day: datetime):
+        """CMR granule metadata (coverage boxes) of all the day's SST files"""
+        name = self.short_name.replace('*', f'.{day.strftime("%Y%m%d")}T*')
+        return "https://cmr.earthdata.nasa.gov/search/granules.json?page_size=2000" \
+               "&provider=OB_DAAC" \
+               f"&readable_granule_name={name}" \
+               "&options[readable_granule_name][pattern]=true"
+
+    def ocbrowser(self, day: datetime = None, bbox: tuple = None):
+        """OBPG browser query, `bbox` (west, south, east, north) overrides the row bbox"""
+        day = date2num(self.tim_min if day is None else day, calendar=u'gregorian',
                        units=u'days since 1970-01-01 00:00:00')
+        west, south, east, north = (self.slon, self.slat, self.elon, self.elat) \
+            if bbox is None else bbox
         dnm, prm = f'&dnm={self.sst_flag.upper()}', 'SST'
         if self.sst_flag in ('3', '4'):
             dnm, prm = '', f'SST{self.sst_flag}'
@@ -269,10 +372,10 @@ class UrlParser:
                f'&sen={self.sen}' \
                '&per=DAY' \
                f'&day={day}' \
-               f'&n={self.elat}' \
-               f'&s={self.slat}' \
-               f'&w={self.slon}' \
-               f'&e={self.elon}' \
+               f'&n={north}' \
+               f'&s={south}' \
+               f'&w={west}' \
+               f'&e={east}' \
                f'{dnm}' \
                f'&prm={prm}'
 
@@ -569,7 +672,8 @@ def validate_lon(lon: float):
 
 class FileSanity:
     def __init__(self, check_list: list, instrument: str, logger,
-                 host: str = 'None', control_list: list = None):
+                 host: str = 'None', control_list: list = None, verified: set = None,
+                 nav_cache=None):
         self.check_list = check_list
         self.instrument = instrument
         self.logger = logger
@@ -577,13 +681,50 @@ class FileSanity:
         self.control_list = control_list
         if control_list is None:
             self.control_list = []
+        # names of files whose download matched the published checksum
+        self.verified = verified
+        if verified is None:
+            self.verified = set()
+        # fused check: with `points` and `window` set, a granule is opened once,
+        # the windows are extracted and the verdict comes from the windows
+        self.nav_cache = nav_cache
+        self.points = None
+        self.window = None
+        self.variables = None
+        # (granule name, (lon, lat)) -> (windows, flags, pixels) of the fused checks
+        self.extracted = {}
+        # granules without valid pixels in the window, kept on disk for the other
+        # rows, deleted by the caller once no later row needs them
+        self.rejected = set()
+        # staged runs (sstage extract) read the fetch stage granules, bad files are
+        # reported, never removed
+        self.keep = False
+
+    def fused(self, file: Path) -> bool:
+        return bool(self.points and self.window) and (self.instrument != 'meris') and \
+               (file.name.endswith('.nc') or file.name.endswith('.h5'))
+
+    def window_check(self, file: Path) -> masked_array:
+        """
+        Valid pixels in the windows of all the variables, windows kept for the match-up;
+        None when none of the variables is in the granule
+        """
+        windows, flags, pixels = extract_windows(file=file, points=self.points, window=self.window,
+                                                 variables=self.variables, nav_cache=self.nav_cache)
+        if len(windows) == 0:
+            return None
+        for i, point in enumerate(self.points):
+            self.extracted[(file.name, tuple(point))] = (
+                {name: data[i:i + 1] for name, data in windows.items()},
+                None if flags is None else flags[i:i + 1], pixels[i:i + 1])
+        return np.ma.masked_invalid(np.stack(list(windows.values())))
 
     def file_check(self, file: Path, sds=None) -> masked_array:
 
         basename = file.name
         if self.instrument in ('octs', 'seawifs', 'modisa', 'viirsn', 'viirsj', 'goci'):
             key = 'chlor_a' if 'OC' in basename else 'sst4' if 'SST4' in basename else 'sst'
-            with Dataset(file, 'r') as dst:
+            with dataset(file=file) as dst:
                 if 'IOP' in basename:
                     key = list(dst.groups['geophysical_data'].variables.keys())[0]
                 sds = dst.groups['geophysical_data'][key][:]
@@ -591,11 +732,10 @@ class FileSanity:
 
         # ~~~~~<>><<>><<>><<>><<>><<>><<>><~~~~~
         if self.instrument == 'meris':
-            sds_obj = SD(file, SDC.READ)
-            sds = sds_obj.select('chlor_a')
-            fill_value = sds.bad_value_scaled
-            sds = sds.get()  # select sds
-            sds_obj.end()
+            with dataset(file=file) as sds_obj:
+                sds = sds_obj.select('chlor_a')
+                fill_value = sds.bad_value_scaled
+                sds = sds.get()  # select sds
             sds = np.ma.masked_where(np.equal(sds, fill_value), sds)
             return sds
 
@@ -606,27 +746,38 @@ class FileSanity:
             if 'SST' in basename:
                 key = 'SST'
 
-            with h5py.File(file, 'r') as dst:
-                sds = dst[f'/Image_data/{key}'][:]
-                mask = np.equal(sds, dst[f'/Image_data/{key}'].attrs['Error_DN'][0])
-                sds = np.ma.masked_array(sds, dtype=np.float32, fill_value=np.float32(-32767))
-                sds.mask = mask
-            return sds
+            # DN domain, no float copy of the scene
+            return read_dn(file=file, key=key)
         return sds
 
+    def remove(self, file: Path) -> str:
+        """Delete a bad granule, unless `keep` is set; what was done, for the log"""
+        if self.keep:
+            return 'kept (staged run)'
+        cmd = 'del /f {file} >nul' if (
+                os.name == 'nt') else 'rm -f {file} 2> /dev/null'
+        release(file=file)
+        if file.is_file():
+            subprocess.call(cmd.format(file=file.absolute()), shell=True)
+        return 'removed'
+
     def check(self) -> list:
         # Sometimes there are empty files that
         # need to be taken care of before mapping...
         keep_files = []
         append = keep_files.append
-        cmd = 'del /f {file} >nul' if (
-                os.name == 'nt') else 'rm -f {file} 2> /dev/null'
 
         # self.logger.info(f'check_list: {self.check_list}')
         for i, file in enumerate(self.check_list):
             check_file = Path(file)
             bsn = check_file.name
-            if f'{bsn}:OK\n' in self.control_list:
+            # intact by checksum or passed before: the structural read is skipped,
+            # the windows of this row are still checked
+            trusted = (f'{bsn}:OK\n' in self.control_list) or \
+                      ((bsn in self.verified) and check_file.is_file())
+            if trusted and not self.fused(file=check_file):
+                if self.logger:
+                    self.logger.info(f'\tFile#: {(i + 1): 3d} | {bsn}: Pass (checked)')
                 append(check_file)
                 continue
             # self.logger.info(f'check_file: {check_file}')
@@ -636,32 +787,56 @@ class FileSanity:
                     or bsn.endswith('.h5')):
                 continue
 
+            windowed = False
             try:
-                data = self.file_check(file=check_file)
+                data = self.window_check(file=check_file) if self.fused(file=check_file) else None
+                windowed = data is not None
+                if (data is None) and trusted:
+                    # no requested variable in the granule, nothing more to read
+                    if self.logger:
+                        self.logger.info(f'\tFile#: {(i + 1): 3d} | {bsn}: Pass (checked)')
+                    append(check_file)
+                    continue
+                if data is None:
+                    # not fused, or no requested variable: the structural read decides
+                    data = self.file_check(file=check_file)
             except Exception as exc:
-                if check_file.is_file():
-                    subprocess.call(cmd.format(file=check_file.absolute()),
-                                    shell=True)
+                if trusted:
+                    # intact file, the windows could not be read: as before the fused check
+                    if self.logger:
+                        self.logger.warning(f'\tFile#: {(i + 1): 3d} | {bsn}: Pass (checked), '
+                                            f'window check failed\n{exc}')
+                    append(check_file)
+                    continue
+                done = self.remove(file=check_file)
                 if self.logger:
-                    self.logger.exception(f'\tFile#: {(i + 1): 3d} | {bsn} | {self.instrument}\n{exc}')
+                    self.logger.exception(f'\tFile#: {(i + 1): 3d} | {bsn} | {self.instrument}: '
+                                          f'BadFile, {done}\n{exc}')
                 if self.host == 'npec':
                     print(f'\tFile#: {(i + 1): 3d} | {bsn} | {self.instrument}\n{exc}', file=sys.stderr)
                 continue
 
             if data is None:
-                subprocess.call(cmd.format(file=check_file), shell=True)
+                done = self.remove(file=check_file)
                 if self.logger:
-                    self.logger.warning(f'\tFile#: {(i + 1): 3d} | {bsn}: BadFile, removed')
+                    self.logger.warning(f'\tFile#: {(i + 1): 3d} | {bsn}: BadFile, {done}')
                 if self.host == 'npec':
-                    print(f'\tFile#: {(i + 1): 3d} | {bsn}: BadFile, removed', file=sys.stderr)
+                    print(f'\tFile#: {(i + 1): 3d} | {bsn}: BadFile, {done}', file=sys.stderr)
+                continue
+
+            if (data[~data.mask].size == 0) and windowed:
+                # valid elsewhere maybe, kept on disk for the other rows
+                if self.logger:
+                    self.logger.info(f'\tFile#: {(i + 1): 3d} | {bsn}: NoValidPixels in window')
+                self.rejected.add(check_file)
                 continue
 
             if data[~data.mask].size == 0:
-                subprocess.call(cmd.format(file=check_file), shell=True)
+                done = self.remove(file=check_file)
                 if self.logger:
-                    self.logger.warning(f'\tFile#: {(i + 1): 3d} | {bsn}: Empty, removed')
+                    self.logger.warning(f'\tFile#: {(i + 1): 3d} | {bsn}: Empty, {done}')
                 if self.host == 'npec':
-                    print(f'\tFile#: {(i + 1): 3d} | {bsn}: Empty, removed', file=sys.stderr)
+                    print(f'\tFile#: {(i + 1): 3d} | {bsn}: Empty, {done}', file=sys.stderr)
                 continue
 
             if data[~data.mask].size > 0: